@@ -0,0 +1,907 @@
+"""Micro-benchmarks for the proxy against a local mock upstream.
+
+Start the stand-in upstream first (see mock_upstream.py), then e.g.:
+
+    python bench_proxy.py transport --upstream http://127.0.0.1:8900/v1/messages --compare
+    python bench_proxy.py compression --upstream "http://127.0.0.1:8900/v1/messages?tokens=2000&delay=0"
+    python bench_proxy.py replay capture.jsonl --speed 1.0
+    python bench_proxy.py memory --compare --image-kb 4096 --concurrency 16
+    python bench_proxy.py images --compare --turns 8 --image-kb 1024
+    python bench_proxy.py soak --requests 5000 --upstream "http://127.0.0.1:8902/v1/messages?tokens=30&delay=0.002&error_rate=0.05&malformed_rate=0.2&drop_rate=0.05&stall_rate=0.01&stall=3"
+
+The proxy runs in-process (Flask test client), so the numbers isolate the proxy
+and its upstream transport from any front-end server.
+"""
+import argparse
+import base64
+import contextlib
+import gc
+import gzip
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+BENCH_KEY = 'sk-bench'
+
+
+def _load_proxy(upstream: str, extra_env: Dict[str, str]):
+    os.environ.update({
+        'UPSTREAM_API_URL': upstream,
+        'UPSTREAM_API_KEY': 'cr_bench',
+        'ALLOWED_API_KEYS': BENCH_KEY,
+        'UPSTREAM_PROXY_URL': '',
+    })
+    os.environ.update(extra_env)
+    import claude_proxy
+    return claude_proxy
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _count_upstream_connections(port: int) -> int:
+    try:
+        import psutil
+    except ImportError:
+        return -1
+    return sum(
+        1 for conn in psutil.Process().net_connections(kind='tcp')
+        if conn.raddr and conn.raddr.port == port and conn.status == 'ESTABLISHED'
+    )
+
+
+# 探测用的流足够长（mock-clean-N 不注入故障）：中断时上游一定还在发送，完整读取的流也要经历多个空闲超时周期
+PROBE_MODEL = 'mock-clean-2000'
+
+
+def _clean_outcome(data: bytes) -> str:
+    """A fault-free stream must reach [DONE] without an error frame (e.g. upstream_stalled)."""
+    return 'finished' if b'data: [DONE]' in data and b'"error"' not in data else 'stalled'
+
+
+# 代理读上游 / 异步关闭上游用的线程名：流结束后还活着说明上游连接没被放掉
+UPSTREAM_THREAD_NAMES = ('upstream-reader', 'upstream-close')
+
+
+def _upstream_threads() -> int:
+    return sum(1 for thread in threading.enumerate() if thread.name in UPSTREAM_THREAD_NAMES)
+
+
+def bench_transport(args) -> bool:
+    """Concurrent streams through the in-process proxy; False when a stream stalls or upstream threads linger."""
+    extra = {'UPSTREAM_HTTP2': 'true' if args.mode == 'h2' else 'false', 'STREAM_IDLE_TIMEOUT': str(args.idle_timeout)}
+    if args.mode == 'h2' and args.upstream.startswith('http://'):
+        extra['UPSTREAM_HTTP2_PRIOR_KNOWLEDGE'] = 'true'
+    proxy = _load_proxy(args.upstream, extra)
+    client = proxy.app.test_client()
+    port = int(args.upstream.split('://', 1)[1].split('/', 1)[0].rsplit(':', 1)[1])
+
+    payload = {'model': 'bench', 'stream': True, 'messages': [{'role': 'user', 'content': 'ping'}]}
+    headers = {'Authorization': f'Bearer {BENCH_KEY}'}
+    # 被中断的流用不注入故障的长流，断开时上游一定还在发送；其余流与它们共享连接
+    aborted_payload = dict(payload, model=PROBE_MODEL)
+    ttfb: List[float] = []
+    totals: List[float] = []
+    errors = [0]
+    aborted = [0]
+    stalled = [0]
+    peak_connections = [0]
+    lock = threading.Lock()
+    remaining = [args.requests]
+    done = threading.Event()
+
+    def _worker() -> None:
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            abort = random.random() < args.abort_rate
+            started = time.perf_counter()
+            first = None
+            chunks = []
+            try:
+                resp = client.post('/v1/chat/completions', json=aborted_payload if abort else payload,
+                                   headers=headers, buffered=False)
+                for chunk in resp.response:
+                    if first is None:
+                        first = time.perf_counter() - started
+                    if abort:
+                        break  # 客户端读到第一块就断开
+                    chunks.append(chunk)
+                resp.close()
+            except Exception:  # noqa: BLE001 - counted, not fatal
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                if abort:
+                    aborted[0] += 1
+                    continue
+                if _clean_outcome(b''.join(chunks)) != 'finished':
+                    stalled[0] += 1
+                ttfb.append(first or 0.0)
+                totals.append(time.perf_counter() - started)
+
+    def _sampler() -> None:
+        while not done.wait(0.05):
+            peak_connections[0] = max(peak_connections[0], _count_upstream_connections(port))
+
+    sampler = threading.Thread(target=_sampler, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=_worker) for _ in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    # 给中断流的读线程一个空闲超时周期收尾，之后仍在的就是泄漏
+    settle_deadline = time.monotonic() + args.idle_timeout + 2
+    while _upstream_threads() and time.monotonic() < settle_deadline:
+        time.sleep(0.1)
+    readers = _upstream_threads()
+
+    print(
+        f"{args.mode}: {len(totals)} streams, concurrency={args.concurrency}, errors={errors[0]}, "
+        f"aborted={aborted[0]}, stalled={stalled[0]}, readers left={readers}, "
+        f"wall={elapsed:.2f}s, rps={len(totals) / elapsed:.1f}, "
+        f"ttfb p50={_percentile(ttfb, 50) * 1000:.1f}ms p99={_percentile(ttfb, 99) * 1000:.1f}ms, "
+        f"total p50={_percentile(totals, 50) * 1000:.1f}ms p99={_percentile(totals, 99) * 1000:.1f}ms, "
+        f"peak upstream connections={peak_connections[0]}"
+    )
+    return stalled[0] == 0 and readers == 0
+
+
+def _agent_payload(turns: int, image_bytes: int) -> Dict:
+    """A long tool-using conversation plus one inline image, shaped like real agent traffic."""
+    rng = random.Random(7)
+    words = ('def', 'return', 'self', 'import', 'config', 'request', 'response', 'error', 'value', 'path',
+             'the', 'file', 'test', 'line', 'function', 'class', 'data', 'result', 'None', 'json')
+    messages: List[Dict] = [{'role': 'system', 'content': 'You are a coding agent. ' * 40}]
+    for i in range(turns):
+        text = ' '.join(rng.choice(words) for _ in range(120))
+        messages.append({'role': 'user', 'content': f"Step {i}: {text}"})
+        messages.append({'role': 'assistant', 'content': None, 'tool_calls': [{
+            'id': f"call_{i}", 'type': 'function',
+            'function': {'name': 'read_file', 'arguments': json.dumps({'path': f"src/module_{i}.py"})}
+        }]})
+        source = '\n'.join(f"    {' '.join(rng.choice(words) for _ in range(10))}" for _ in range(60))
+        messages.append({'role': 'tool', 'tool_call_id': f"call_{i}", 'content': source})
+    try:
+        from PIL import Image
+        side = max(16, int((image_bytes / 3) ** 0.5))
+        img = Image.frombytes('RGB', (side, side), bytes(rng.getrandbits(8) for _ in range(side * side * 3)))
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=90)
+        image = buf.getvalue()
+    except ImportError:
+        image = bytes(rng.getrandbits(8) for _ in range(image_bytes))  # JPEG 数据本身近似不可压缩
+    messages.append({'role': 'user', 'content': [
+        {'type': 'text', 'text': 'What does this screenshot show?'},
+        {'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,' + base64.b64encode(image).decode('ascii')}}
+    ]})
+    return {'model': 'bench', 'stream': False, 'messages': messages}
+
+
+def _median_ms(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def bench_compression(args) -> None:
+    proxy = _load_proxy(args.upstream, {'COMPRESSION_MIN_BYTES': '1024', 'UPSTREAM_REQUEST_ENCODING': args.upstream_encoding})
+    cfg = proxy.current_config()
+    raw = json.dumps(_agent_payload(args.turns, args.image_kb * 1024)).encode('utf-8')
+    codecs = ['gzip'] + (['zstd'] if proxy._zstd_available() else [])
+
+    print(f"request body: {len(raw) / 1024:.0f} KiB ({args.turns} turns + {args.image_kb} KiB image), "
+          f"upstream encoding: {args.upstream_encoding or 'identity'}")
+    encoded = {'identity': raw}
+    for codec in codecs:
+        encoded[codec] = proxy.compress_body(raw, codec, cfg)
+        compress_ms = _median_ms(lambda: proxy.compress_body(raw, codec, cfg), args.repeat)
+        decompress_ms = _median_ms(
+            lambda: proxy.decompress_body(encoded[codec], codec, cfg.max_decompressed_body_bytes), args.repeat)
+        print(f"  {codec:<8} {len(encoded[codec]) / 1024:8.0f} KiB  ratio={len(raw) / len(encoded[codec]):.2f}  "
+              f"compress={compress_ms:.1f}ms  decompress={decompress_ms:.1f}ms")
+
+    client = proxy.app.test_client()
+    for codec, body in encoded.items():
+        headers = {'Authorization': f'Bearer {BENCH_KEY}', 'Content-Type': 'application/json'}
+        if codec != 'identity':
+            headers['Content-Encoding'] = codec
+            headers['Accept-Encoding'] = codec
+        sizes = []
+
+        def _roundtrip() -> None:
+            resp = client.post('/v1/chat/completions', data=body, headers=headers)
+            assert resp.status_code == 200, resp.status_code
+            sizes.append(len(resp.data))
+
+        elapsed = _median_ms(_roundtrip, args.repeat)
+        print(f"  end-to-end {codec:<8} request={len(body) / 1024:.0f} KiB  response={sizes[-1] / 1024:.1f} KiB  "
+              f"median={elapsed:.1f}ms")
+
+
+def _rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_memory(args) -> None:
+    """Peak RSS growth while N requests with a large inline data: URL image are in flight at once."""
+    proxy = _load_proxy(args.upstream, {'LEAN_REQUEST_BODIES': 'true' if args.mode == 'lean' else 'false'})
+    client = proxy.app.test_client()
+    headers = {'Authorization': f'Bearer {BENCH_KEY}', 'Content-Type': 'application/json'}
+    image = base64.b64encode(os.urandom(args.image_kb * 1024)).decode('ascii')
+    # 所有请求共用同一份请求体字节，客户端一侧只占一份内存
+    body = json.dumps({'model': 'bench', 'messages': [{'role': 'user', 'content': [
+        {'type': 'text', 'text': 'Describe this image.'},
+        {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,' + image}}
+    ]}]}).encode('utf-8')
+    del image
+    assert client.post('/v1/chat/completions', data=body, headers=headers).status_code == 200  # 预热
+
+    baseline = _rss_bytes()
+    peak = [baseline]
+    errors = [0]
+    barrier = threading.Barrier(args.concurrency)
+    done = threading.Event()
+
+    def _worker() -> None:
+        barrier.wait()
+        resp = client.post('/v1/chat/completions', data=body, headers=headers)
+        if resp.status_code != 200:
+            errors[0] += 1
+
+    def _sampler() -> None:
+        # ru_maxrss 会继承父进程（--compare）的峰值，这里自己采样
+        while not done.wait(0.002):
+            peak[0] = max(peak[0], _rss_bytes())
+
+    sampler = threading.Thread(target=_sampler, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=_worker) for _ in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    growth = peak[0] - baseline
+    per_request = growth / args.concurrency
+    print(f"{args.mode}: {args.concurrency} concurrent requests x {len(body) / 1048576:.1f} MiB body, errors={errors[0]}, "
+          f"wall={elapsed:.2f}s, peak RSS +{growth / 1048576:.0f} MiB = {per_request / 1048576:.1f} MiB/request "
+          f"({per_request / len(body):.1f}x body)")
+
+
+def _open_fds() -> int:
+    try:
+        import psutil
+        return psutil.Process().num_fds()
+    except ImportError:
+        return len(os.listdir('/proc/self/fd'))
+
+
+def _pool_stats(proxy) -> Dict[str, int]:
+    """Upstream connection pools: idle / checked-out HTTP/1.1 connections and active HTTP/2 streams."""
+    idle = in_use = 0
+    for adapter in proxy.UPSTREAM_SESSION.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # 队列预先填满 None 占位：非 None 的是空闲连接，缺少的格子是被借出的连接
+            slots = list(pool.pool.queue)
+            idle += sum(1 for conn in slots if conn is not None)
+            in_use += pool.pool.maxsize - len(slots)
+    h2_streams = sum(sum(lanes) for transport in list(proxy._HTTP2_TRANSPORTS.values())
+                     for lanes in transport.stats().values())
+    return {'h1_idle': idle, 'h1_in_use': in_use, 'h2_streams': h2_streams}
+
+
+def _soak_sample(proxy, port: int) -> Dict[str, float]:
+    sample: Dict[str, float] = {'rss_mib': _rss_bytes() / 1048576, 'fds': _open_fds(),
+                                'threads': threading.active_count(), 'readers': _upstream_threads(),
+                                'upstream_conns': _count_upstream_connections(port)}
+    sample.update(_pool_stats(proxy))
+    return sample
+
+
+def _slope_per_1k(points: List[tuple]) -> float:
+    """Least-squares slope of (requests done, value) points, per 1000 requests."""
+    if len(points) < 2:
+        return 0.0
+    mean_x = statistics.fmean(x for x, _ in points)
+    mean_y = statistics.fmean(y for _, y in points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    return 1000 * sum((x - mean_x) * (y - mean_y) for x, y in points) / var if var else 0.0
+
+
+class _LogTally(io.TextIOBase):
+    """stdout stand-in for the proxy during a soak: counts failure-path log lines, optionally tees to a file."""
+
+    MARKERS = ('Stream decode error', 'Stream error', 'Stream stalled', 'API Error', '❌ Error')
+
+    def __init__(self, path: str):
+        self.counts = {marker: 0 for marker in self.MARKERS}
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            for marker in self.MARKERS:
+                if marker in text:
+                    self.counts[marker] += 1
+            if self._file:
+                self._file.write(text)
+        return len(text)
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+        super().close()
+
+
+class _InProcessSoak:
+    """Soak target: the proxy imported into this process and driven through Flask's test client."""
+
+    label = 'in-process'
+
+    def __init__(self, args, extra: Dict[str, str], tally: '_LogTally'):
+        with contextlib.redirect_stdout(tally):
+            self.proxy = _load_proxy(args.upstream, extra)
+        self.client = self.proxy.app.test_client()
+        self.port = _port_of(args.upstream)
+
+    def one(self, kind: str, path: str, body: Dict) -> str:
+        if kind == 'nonstream':
+            return str(self.client.post(path, json=body, headers=SOAK_HEADERS).status_code)
+        resp = self.client.post(path, json=dict(body, stream=True), headers=SOAK_HEADERS, buffered=False)
+        chunks = []
+        try:
+            for chunk in resp.response:
+                if kind == 'abort':
+                    break  # 客户端读到第一块就断开（只是关闭响应迭代器，没有真实的 socket）
+                chunks.append(chunk)
+        finally:
+            resp.close()
+        if kind == 'clean':
+            return _clean_outcome(b''.join(chunks))
+        return 'aborted' if kind == 'abort' else str(resp.status_code)
+
+    def sample(self) -> Dict[str, float]:
+        return _soak_sample(self.proxy, self.port)
+
+    def checks(self, baseline: Dict[str, float], final: Dict[str, float]) -> List[tuple]:
+        return [
+            ('HTTP/1.1 connections still checked out', final['h1_in_use'], 0),
+            ('HTTP/2 streams still active', final['h2_streams'], 0),
+            ('upstream reader/close threads left', final['readers'], 0),
+        ]
+
+    def close(self) -> None:
+        pass
+
+
+class _GunicornSoak:
+    """Soak target: `gunicorn -w 1 -k gthread` in a subprocess, driven over real TCP connections.
+
+    Aborted streams are reset (SO_LINGER 0) after the first chunk, so the worker sees a
+    genuine client disconnect. Samples cover the worker process; pool internals are not
+    visible from outside, so sockets left in CLOSE_WAIT on the client side are checked instead.
+    """
+
+    label = 'gunicorn -w 1'
+
+    def __init__(self, args, extra: Dict[str, str], tally: '_LogTally'):
+        import psutil
+
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.listen_port = probe.getsockname()[1]
+        self.port = _port_of(args.upstream)
+        env = dict(os.environ, UPSTREAM_API_URL=args.upstream, UPSTREAM_API_KEY='cr_bench', ALLOWED_API_KEYS=BENCH_KEY,
+                   UPSTREAM_PROXY_URL='', PYTHONUNBUFFERED='1', **extra)
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(args.gunicorn_threads),
+               '-b', f"127.0.0.1:{self.listen_port}", '--timeout', '300', 'claude_proxy:app']
+        self.master = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        threading.Thread(target=self._pump, args=(tally,), name='gunicorn-log', daemon=True).start()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', self.listen_port), timeout=1):
+                    break
+            except OSError:
+                if self.master.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"gunicorn did not start (exit code {self.master.poll()})")
+                time.sleep(0.2)
+        self.worker = psutil.Process(self.master.pid).children()[0]
+
+    def _pump(self, tally: '_LogTally') -> None:
+        for line in self.master.stdout:
+            tally.write(line)
+
+    def one(self, kind: str, path: str, body: Dict) -> str:
+        conn = http.client.HTTPConnection('127.0.0.1', self.listen_port, timeout=60)
+        try:
+            payload = json.dumps(dict(body, stream=kind != 'nonstream')).encode('utf-8')
+            conn.request('POST', path, body=payload, headers=dict(SOAK_HEADERS, **{'Content-Type': 'application/json'}))
+            resp = conn.getresponse()
+            if kind != 'abort':
+                data = resp.read()
+                return _clean_outcome(data) if kind == 'clean' else str(resp.status)
+            resp.read1(1)
+            # 读到第一块后发 RST 断开，和真实客户端崩溃/取消一样
+            conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            resp.close()
+            return 'aborted'
+        finally:
+            conn.close()
+
+    def sample(self) -> Dict[str, float]:
+        conns = self.worker.net_connections(kind='tcp')
+        return {
+            'rss_mib': self.worker.memory_info().rss / 1048576,
+            'fds': self.worker.num_fds(),
+            'threads': self.worker.num_threads(),
+            'upstream_conns': sum(1 for c in conns if c.raddr and c.raddr.port == self.port and c.status == 'ESTABLISHED'),
+            'client_close_wait': sum(1 for c in conns if c.laddr and c.laddr.port == self.listen_port
+                                     and c.status == 'CLOSE_WAIT'),
+        }
+
+    def checks(self, baseline: Dict[str, float], final: Dict[str, float]) -> List[tuple]:
+        return [('client sockets left in CLOSE_WAIT', final['client_close_wait'], 0)]
+
+    def close(self) -> None:
+        self.master.terminate()
+        try:
+            self.master.wait(10)
+        except subprocess.TimeoutExpired:
+            self.master.kill()
+
+
+SOAK_HEADERS = {'Authorization': f'Bearer {BENCH_KEY}'}
+
+
+def _port_of(url: str) -> int:
+    return int(url.split('://', 1)[1].split('/', 1)[0].rsplit(':', 1)[1])
+
+
+def bench_soak(args) -> bool:
+    """Thousands of mixed requests with client aborts and upstream faults; False when resources keep growing."""
+    extra = {'STREAM_IDLE_TIMEOUT': str(args.idle_timeout), 'UPSTREAM_HTTP2': 'true' if args.mode == 'h2' else 'false'}
+    if args.mode == 'h2' and args.upstream.startswith('http://'):
+        extra['UPSTREAM_HTTP2_PRIOR_KNOWLEDGE'] = 'true'
+    report = sys.stdout
+    tally = _LogTally(args.proxy_log)
+    target = (_GunicornSoak if args.server == 'gunicorn' else _InProcessSoak)(args, extra, tally)
+    chat = {'model': 'bench', 'messages': [{'role': 'user', 'content': 'ping'}]}
+    passthrough = {'model': 'bench', 'max_tokens': 64, 'messages': [{'role': 'user', 'content': 'ping'}]}
+    kinds = ('stream', 'abort', 'nonstream', 'messages')
+    weights = (1 - args.abort_rate - args.nonstream_rate - args.messages_rate, args.abort_rate,
+               args.nonstream_rate, args.messages_rate)
+    counts: Dict[str, int] = {}
+    lock = threading.Lock()
+    issued = [0]
+    started = time.monotonic()
+    deadline = started + args.duration if args.duration > 0 else None
+
+    def _worker(seed: int, limit: int) -> None:
+        rng = random.Random(seed)
+        while True:
+            with lock:
+                if issued[0] >= limit or (deadline and time.monotonic() > deadline):
+                    return
+                issued[0] += 1
+            kind = rng.choices(kinds, weights)[0]
+            path, body = ('/v1/messages', passthrough) if kind == 'messages' else ('/v1/chat/completions', chat)
+            try:
+                outcome = target.one(kind, path, body)
+            except Exception as exc:  # noqa: BLE001 - counted, the soak keeps going
+                outcome = f"exception:{type(exc).__name__}"
+            with lock:
+                counts[f"{kind} {outcome}"] = counts.get(f"{kind} {outcome}", 0) + 1
+
+    def _run(limit: int, samples: List[tuple]) -> None:
+        workers = [threading.Thread(target=_worker, args=(limit * 1000 + i, limit), name=f"soak-{i}")
+                   for i in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(args.sample_interval)
+            sample = target.sample()
+            samples.append((issued[0], sample))
+            print(f"{time.monotonic() - started:7.1f}s requests={issued[0]:6d} "
+                  + ' '.join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                             for key, value in sample.items()), file=report, flush=True)
+        for worker in workers:
+            worker.join()
+
+    def _abort_probe() -> Dict[str, int]:
+        # 先中断一批长流，再发一批不注入故障的流：共享连接（HTTP/2 lane）被中断的流拖住时后者会卡住
+        outcomes: Dict[str, int] = {}
+        for _ in range(args.probe_rounds):
+            for kind in ('abort', 'clean'):
+                def _probe(kind=kind) -> None:
+                    started_at = time.monotonic()
+                    try:
+                        outcome = target.one(kind, '/v1/chat/completions', dict(chat, model=PROBE_MODEL))
+                    except Exception as exc:  # noqa: BLE001 - counted as a failure below
+                        outcome = f"exception:{type(exc).__name__}"
+                    if kind == 'clean' and outcome == 'finished' and time.monotonic() - started_at > args.probe_max_seconds:
+                        outcome = 'slow'
+                    with lock:
+                        outcomes[f"{kind} {outcome}"] = outcomes.get(f"{kind} {outcome}", 0) + 1
+
+                probes = [threading.Thread(target=_probe, name=f"probe-{i}") for i in range(args.probe_streams)]
+                for probe in probes:
+                    probe.start()
+                for probe in probes:
+                    probe.join()
+        return outcomes
+
+    def _settle() -> Dict[str, float]:
+        # 空闲后再采样：给看门狗读线程/异步关闭线程收尾的时间，基线与终点在同样的空闲状态下比较
+        time.sleep(args.settle)
+        gc.collect()
+        return target.sample()
+
+    samples: List[tuple] = []
+    try:
+        with contextlib.redirect_stdout(tally):
+            _run(args.warmup, [])
+            baseline = _settle()
+            print(f"baseline after {issued[0]} warm-up requests: rss={baseline['rss_mib']:.1f}MiB fds={baseline['fds']} "
+                  f"threads={baseline['threads']}", file=report, flush=True)
+            _run(args.warmup + args.requests, samples)
+            probed = _abort_probe()
+            final = _settle()
+    finally:
+        target.close()
+        tally.close()
+
+    elapsed = time.monotonic() - started
+    print(f"\n{issued[0]} requests in {elapsed:.1f}s, server={target.label}, mode={args.mode}, "
+          f"concurrency={args.concurrency}", file=report)
+    for outcome, count in sorted(counts.items()):
+        print(f"  {outcome:<28} {count}", file=report)
+    for marker, count in tally.counts.items():
+        print(f"  log '{marker}': {count}", file=report)
+    for outcome, count in sorted(probed.items()):
+        print(f"  probe {outcome:<22} {count}", file=report)
+    checks = [
+        ('RSS growth (MiB)', final['rss_mib'] - baseline['rss_mib'], args.max_rss_growth_mb),
+        ('open FD growth', final['fds'] - baseline['fds'], args.max_fd_growth),
+        ('thread growth', final['threads'] - baseline['threads'], args.max_thread_growth),
+        ('clean streams stalled after aborts', sum(count for outcome, count in probed.items()
+                                                    if outcome.startswith('clean') and outcome != 'clean finished'), 0),
+    ] + target.checks(baseline, final)
+    ok = True
+    for label, value, bound in checks:
+        passed = value <= bound
+        ok = ok and passed
+        print(f"  {'✅' if passed else '❌'} {label}: {value:.1f} (bound {bound})", file=report)
+    points = [(done, sample['rss_mib']) for done, sample in samples]
+    print(f"  RSS trend under load: {_slope_per_1k(points):+.2f} MiB per 1000 requests", file=report)
+    print('PASS' if ok else 'FAIL', file=report)
+    return ok
+
+
+def bench_images(args) -> None:
+    """A vision conversation that re-sends every earlier image on each turn: upstream bytes and TTFT per turn."""
+    import mock_upstream
+
+    query = f"tokens=20&delay=0.01&file_error_rate={args.file_error_rate}&file_expiry={args.file_expiry}"
+    upstream = f"{_start_local_upstream()}?{query}"
+    with contextlib.redirect_stdout(io.StringIO()):
+        proxy = _load_proxy(upstream, {'IMAGE_FILE_UPLOADS': 'true' if args.mode == 'files' else 'false'})
+    client = proxy.app.test_client()
+    headers = {'Authorization': f'Bearer {BENCH_KEY}'}
+    rng = random.Random(11)
+    messages: List[Dict] = []
+    ttfts: List[float] = []
+    for turn in range(args.turns):
+        image = base64.b64encode(rng.randbytes(args.image_kb * 1024)).decode('ascii')
+        messages.append({'role': 'user', 'content': [
+            {'type': 'text', 'text': f"Turn {turn}: compare this screenshot with the previous ones."},
+            {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,' + image}}
+        ]})
+        before = dict(mock_upstream.STATS)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            resp = client.post('/v1/chat/completions', json={'model': 'bench', 'stream': True, 'messages': messages},
+                               headers=headers, buffered=False)
+            chunks = iter(resp.response)
+            next(chunks, None)
+            ttft = (time.perf_counter() - started) * 1000
+            for _chunk in chunks:
+                pass
+            resp.close()
+        ttfts.append(ttft)
+        messages.append({'role': 'assistant', 'content': 'Noted.'})
+        sent = mock_upstream.STATS['message_bytes'] - before['message_bytes']
+        print(f"  turn {turn + 1:2d}: {turn + 1} images, status={resp.status_code}, "
+              f"messages body={sent / 1048576:6.2f} MiB, ttft={ttft:6.1f}ms")
+        # 模拟用户思考时间；files 模式的后台上传在此期间完成
+        with contextlib.redirect_stdout(io.StringIO()):
+            time.sleep(args.think)
+    stats = mock_upstream.STATS
+    print(f"{args.mode}: {args.turns} turns x {args.image_kb} KiB image, upstream bytes "
+          f"messages={stats['message_bytes'] / 1048576:.1f} MiB files={stats['file_bytes'] / 1048576:.1f} MiB "
+          f"({stats['files']} uploads), ttft median={statistics.median(ttfts):.1f}ms last={ttfts[-1]:.1f}ms")
+
+
+def _expand_placeholders(value, seed: int, remote_bytes: int):
+    """Turn capture placeholders back into (random, same-sized) base64 payloads."""
+    if isinstance(value, dict):
+        return {key: _expand_placeholders(item, seed, remote_bytes) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand_placeholders(item, seed + index, remote_bytes) for index, item in enumerate(value)]
+    if isinstance(value, str) and value.startswith('placeholder:'):
+        spec = value[len('placeholder:'):]
+        if spec == 'redacted':
+            return value  # 凭据不回放，保留占位符
+        if spec.startswith('bytes='):
+            # Anthropic 格式的 base64 source：media_type 在相邻字段里
+            return base64.b64encode(random.Random(seed).randbytes(int(spec[6:]))).decode('ascii')
+        if spec == 'remote':
+            media_type, size = 'image/jpeg', remote_bytes
+        else:
+            media_type, _, size_text = spec.partition(';bytes=')
+            size = int(size_text or 0)
+        # 随机字节与真实图片一样几乎不可压缩
+        payload = base64.b64encode(random.Random(seed).randbytes(size)).decode('ascii')
+        return f"data:{media_type or 'image/jpeg'};base64,{payload}"
+    return value
+
+
+def _replay_request(record: Dict, index: int, remote_bytes: int) -> Dict:
+    body = _expand_placeholders(record.get('request') or {}, index, remote_bytes)
+    marker = f"<<replay:{index}>>"
+    if record.get('endpoint') == 'messages':
+        system = body.get('system')
+        if isinstance(system, list):
+            body['system'] = [{'type': 'text', 'text': marker}] + system
+        else:
+            body['system'] = f"{marker}\n{system}" if system else marker
+    else:
+        body['messages'] = [{'role': 'system', 'content': marker}] + list(body.get('messages') or [])
+    return body
+
+
+def _start_local_upstream(capture: str = '') -> str:
+    """Serve mock_upstream.py from this process (its STATS stay readable); optionally in replay mode."""
+    import logging
+
+    from werkzeug.serving import make_server
+
+    import mock_upstream
+    if capture:
+        mock_upstream.load_replay(capture)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, mock_upstream.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='local-upstream', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/v1/messages"
+
+
+def _distribution(label: str, values: List[float]) -> str:
+    if not values:
+        return f"{label}: n/a"
+    return (f"{label}: p50={_percentile(values, 50):.0f}ms p90={_percentile(values, 90):.0f}ms "
+            f"p99={_percentile(values, 99):.0f}ms max={max(values):.0f}ms")
+
+
+def bench_replay(args) -> None:
+    with open(args.capture, 'r', encoding='utf-8') as fh:
+        records = [(number, json.loads(line)) for number, line in enumerate(fh) if line.strip()]
+    records.sort(key=lambda item: item[1].get('ts') or 0)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print('capture file is empty')
+        return
+
+    upstream = args.upstream or _start_local_upstream(args.capture)
+    # 回放时关闭采集/账本，避免把回放流量再记录一遍
+    proxy = _load_proxy(upstream, {'CAPTURE_PATH': '', 'USAGE_LEDGER_PATH': ''})
+    client = proxy.app.test_client()
+    headers = {'Authorization': f'Bearer {BENCH_KEY}'}
+
+    lock = threading.Lock()
+    latency: List[float] = []
+    ttft: List[float] = []
+    lateness: List[float] = []
+    statuses: Dict[int, int] = {}
+    slots = threading.Semaphore(args.max_in_flight)
+
+    def _run(number: int, record: Dict, scheduled: float) -> None:
+        try:
+            body = _replay_request(record, number, args.remote_image_kb * 1024)
+            path = '/v1/messages' if record.get('endpoint') == 'messages' else '/v1/chat/completions'
+            started = time.perf_counter()
+            first = None
+            resp = client.post(path, json=body, headers=headers, buffered=False)
+            for chunk in resp.response:
+                if first is None and (b'"content"' in chunk or b'tool_calls' in chunk or b'content_block_delta' in chunk):
+                    first = time.perf_counter() - started
+            resp.close()
+            elapsed = time.perf_counter() - started
+            with lock:
+                statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+                latency.append(elapsed * 1000)
+                lateness.append((started - scheduled) * 1000)
+                if first is not None and record.get('stream'):
+                    ttft.append(first * 1000)
+        finally:
+            slots.release()
+
+    base_ts = records[0][1].get('ts') or 0
+    began = time.perf_counter()
+    threads = []
+    for number, record in records:
+        # 按原始到达间隔（除以 --speed）发出请求
+        scheduled = began + ((record.get('ts') or base_ts) - base_ts) / args.speed
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        slots.acquire()
+        thread = threading.Thread(target=_run, args=(number, record, scheduled), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - began
+
+    print(f"replayed {len(records)} requests in {wall:.1f}s (speed x{args.speed}), statuses={statuses}")
+    print('  ' + _distribution('latency (replay)  ', latency))
+    print('  ' + _distribution('latency (captured)', [r.get('latency_ms') or 0 for _, r in records]))
+    print('  ' + _distribution('ttft    (replay)  ', ttft))
+    print('  ' + _distribution('ttft    (captured)', [r['ttft_ms'] for _, r in records if r.get('stream') and r.get('ttft_ms') is not None]))
+    print('  ' + _distribution('start lateness    ', lateness))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    transport = sub.add_parser('transport', help='concurrent streams over HTTP/1.1 vs HTTP/2')
+    transport.add_argument('--upstream', default='http://127.0.0.1:8900/v1/messages')
+    transport.add_argument('--mode', choices=('h1', 'h2'), default='h1')
+    transport.add_argument('--compare', action='store_true', help='run h1 and h2 in separate processes')
+    transport.add_argument('--concurrency', type=int, default=200)
+    transport.add_argument('--requests', type=int, default=1000)
+    transport.add_argument('--abort-rate', type=float, default=0,
+                           help='streams sent as long fault-free streams (mock-clean-2000) and dropped after the first chunk')
+    transport.add_argument('--idle-timeout', type=float, default=2.0,
+                           help='STREAM_IDLE_TIMEOUT; completed streams that hit it count as stalled')
+
+    compression = sub.add_parser('compression', help='request/response body compression: bytes and CPU time')
+    compression.add_argument('--upstream', default='http://127.0.0.1:8900/v1/messages?tokens=2000&delay=0')
+    compression.add_argument('--turns', type=int, default=80)
+    compression.add_argument('--image-kb', type=int, default=400)
+    compression.add_argument('--repeat', type=int, default=15)
+    compression.add_argument('--upstream-encoding', choices=('', 'gzip', 'zstd'), default='',
+                             help='also compress the proxy -> upstream body (mock_upstream.py --accept-encoding)')
+
+    memory = sub.add_parser('memory', help='peak RSS per concurrent request carrying a large inline image')
+    memory.add_argument('--upstream', default='http://127.0.0.1:8900/v1/messages?tokens=20&delay=0.02')
+    memory.add_argument('--mode', choices=('lean', 'copy'), default='lean', help='LEAN_REQUEST_BODIES=true / false')
+    memory.add_argument('--compare', action='store_true', help='run lean and copy in separate processes')
+    memory.add_argument('--image-kb', type=int, default=4096)
+    memory.add_argument('--concurrency', type=int, default=16)
+
+    soak = sub.add_parser('soak', help='long mixed run with faults; fails when RSS/FDs/threads/pools keep growing')
+    soak.add_argument('--upstream', default='http://127.0.0.1:8900/v1/messages?tokens=30&delay=0.002&error_rate=0.05'
+                                            '&malformed_rate=0.2&drop_rate=0.05&stall_rate=0.01&stall=3')
+    soak.add_argument('--mode', choices=('h1', 'h2'), default='h1')
+    soak.add_argument('--server', choices=('inprocess', 'gunicorn'), default='inprocess',
+                      help='in-process test client, or gunicorn -w 1 over real TCP with RST client aborts (needs psutil)')
+    soak.add_argument('--gunicorn-threads', type=int, default=64, help='gthread worker threads with --server gunicorn')
+    soak.add_argument('--requests', type=int, default=5000, help='requests after warm-up')
+    soak.add_argument('--duration', type=float, default=0, help='stop after this many seconds (0 = run all requests)')
+    soak.add_argument('--warmup', type=int, default=500, help='requests before the baseline sample')
+    soak.add_argument('--concurrency', type=int, default=32)
+    soak.add_argument('--abort-rate', type=float, default=0.1, help='streams the client drops after the first chunk')
+    soak.add_argument('--nonstream-rate', type=float, default=0.2)
+    soak.add_argument('--messages-rate', type=float, default=0.2, help='streams sent to the /v1/messages passthrough')
+    soak.add_argument('--idle-timeout', type=float, default=1.0, help='STREAM_IDLE_TIMEOUT, so stall faults trip the watchdog')
+    soak.add_argument('--sample-interval', type=float, default=2.0)
+    soak.add_argument('--settle', type=float, default=3.0, help='idle seconds before the final sample')
+    soak.add_argument('--probe-rounds', type=int, default=5,
+                      help='after the run: rounds of aborted long streams followed by fault-free streams')
+    soak.add_argument('--probe-streams', type=int, default=8, help='aborted and fault-free streams per probe round')
+    soak.add_argument('--probe-max-seconds', type=float, default=30.0, help='fault-free probe streams slower than this fail')
+    soak.add_argument('--max-rss-growth-mb', type=float, default=64)
+    soak.add_argument('--max-fd-growth', type=int, default=16)
+    soak.add_argument('--max-thread-growth', type=int, default=4)
+    soak.add_argument('--proxy-log', default=os.devnull, help='where the proxy\'s own logging goes')
+
+    images = sub.add_parser('images', help='multi-turn vision conversation: inline images vs upstream Files API')
+    images.add_argument('--mode', choices=('inline', 'files'), default='files', help='IMAGE_FILE_UPLOADS=false / true')
+    images.add_argument('--compare', action='store_true', help='run inline and files in separate processes')
+    images.add_argument('--turns', type=int, default=8)
+    images.add_argument('--image-kb', type=int, default=1024)
+    images.add_argument('--think', type=float, default=0.3, help='pause between turns')
+    images.add_argument('--file-error-rate', type=float, default=0, help='share of uploads the stand-in fails')
+    images.add_argument('--file-expiry', type=float, default=0, help='seconds before the stand-in forgets a file')
+
+    replay = sub.add_parser('replay', help='re-drive captured traffic (CAPTURE_PATH) with its original timings')
+    replay.add_argument('capture', help='JSONL written by the proxy with CAPTURE_PATH')
+    replay.add_argument('--upstream', help='stand-in upstream started with mock_upstream.py --replay (default: in-process)')
+    replay.add_argument('--speed', type=float, default=1.0, help='divide inter-arrival gaps by this factor')
+    replay.add_argument('--limit', type=int, default=0)
+    replay.add_argument('--max-in-flight', type=int, default=256)
+    replay.add_argument('--remote-image-kb', type=int, default=100, help='size used for captured remote image URLs')
+
+    args = parser.parse_args()
+    if args.bench == 'replay':
+        bench_replay(args)
+    elif args.bench == 'compression':
+        bench_compression(args)
+    elif args.bench == 'soak':
+        sys.exit(0 if bench_soak(args) else 1)
+    elif args.bench == 'images':
+        if args.compare:
+            for mode in ('inline', 'files'):
+                cmd = [sys.executable, __file__, 'images', '--mode', mode, '--turns', str(args.turns),
+                       '--image-kb', str(args.image_kb), '--think', str(args.think),
+                       '--file-error-rate', str(args.file_error_rate), '--file-expiry', str(args.file_expiry)]
+                output = subprocess.run(cmd, capture_output=True, text=True).stdout
+                print(output.strip().splitlines()[-1] if output.strip() else f"{mode}: no output")
+        else:
+            bench_images(args)
+    elif args.bench == 'memory':
+        if args.compare:
+            for mode in ('copy', 'lean'):
+                cmd = [sys.executable, __file__, 'memory', '--upstream', args.upstream, '--mode', mode,
+                       '--image-kb', str(args.image_kb), '--concurrency', str(args.concurrency)]
+                output = subprocess.run(cmd, capture_output=True, text=True).stdout
+                print(output.strip().splitlines()[-1] if output.strip() else f"{mode}: no output")
+        else:
+            bench_memory(args)
+    elif args.bench == 'transport':
+        if args.compare:
+            ok = True
+            for mode in ('h1', 'h2'):
+                cmd = [sys.executable, __file__, 'transport', '--upstream', args.upstream, '--mode', mode,
+                       '--concurrency', str(args.concurrency), '--requests', str(args.requests),
+                       '--abort-rate', str(args.abort_rate), '--idle-timeout', str(args.idle_timeout)]
+                result = subprocess.run(cmd, capture_output=True, text=True)
+                output = result.stdout
+                print(output.strip().splitlines()[-1] if output.strip() else f"{mode}: no output")
+                ok = ok and result.returncode == 0
+            sys.exit(0 if ok else 1)
+        sys.exit(0 if bench_transport(args) else 1)
+
+
+if __name__ == '__main__':
+    main()
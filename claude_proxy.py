@@ -1,17 +1,34 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, has_request_context, stream_with_context
 from flask_cors import CORS
+from werkzeug.wsgi import get_input_stream
 import os
 import json
 import requests
 import hashlib
 import time
 import uuid
-from typing import Iterator, List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional, Callable
 from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import socket
-from urllib.parse import urlparse
+import threading
+import queue
+import re
+from urllib.parse import urlparse, urlunparse
 import base64
 import mimetypes
+import io
+import gzip
+import zlib
+import importlib
+import random
+import atexit
+from datetime import datetime, timezone
+import signal
+from typing import Mapping
+
+_STARTUP_BEGAN = time.perf_counter()
 
 app = Flask(__name__)
 
@@ -25,19 +42,30 @@ CORS(app, resources={
     r"/*": {
         "origins": _cors_origins,
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": [
+            "Content-Type", "Authorization", "x-api-key", "anthropic-version", "anthropic-beta",
+            "X-Request-Timeout", "X-Stainless-Timeout", "Content-Encoding"
+        ]
     }
 })
 
-# 配置
-# 上游 Claude 兼容 API（fizzlycode 兼容层）
-API_URL = os.getenv("UPSTREAM_API_URL", "https://fizzlycode.com/api/v1/messages?beta=true")
+_OPTIONAL_MODULES: Dict[str, Any] = {}
 
-# 上游鉴权（务必通过环境变量覆盖默认值）
-UPSTREAM_API_KEY_PLACEHOLDER = "cr_set_upstream_api_key"
-UPSTREAM_API_KEY = os.getenv("UPSTREAM_API_KEY", UPSTREAM_API_KEY_PLACEHOLDER)
-if UPSTREAM_API_KEY == UPSTREAM_API_KEY_PLACEHOLDER:
-    print("⚠️ 未检测到 UPSTREAM_API_KEY 环境变量，默认占位值会导致上游 401。请在部署前设置真实值。")
+
+def _optional_import(name: str) -> Any:
+    """Import an optional dependency on first use (keeps worker start-up fast); None if missing."""
+    if name not in _OPTIONAL_MODULES:
+        try:
+            _OPTIONAL_MODULES[name] = importlib.import_module(name)
+        except ImportError:
+            _OPTIONAL_MODULES[name] = None
+    return _OPTIONAL_MODULES[name]
+
+
+def _strtobool(val: Optional[str]) -> bool:
+    if val is None:
+        return False
+    return str(val).strip().lower() in {"1", "true", "yes", "y", "on"}
 
 
 def _parse_allowed_api_keys(raw: str) -> set:
@@ -49,124 +77,342 @@ def _parse_allowed_api_keys(raw: str) -> set:
     }
 
 
-# 代理自身鉴权（给你的客户端用）
-ALLOWED_API_KEYS = _parse_allowed_api_keys(os.getenv("ALLOWED_API_KEYS", "sk-test123,sk-test456"))
-if not ALLOWED_API_KEYS:
-    print("⚠️ ALLOWED_API_KEYS 为空，所有请求都会被拒绝。请配置允许访问的客户端 key。")
+def _parse_model_aliases(raw: str) -> Dict[str, str]:
+    # 逗号分隔的 from:to 列表，例如 "claude-sonnet-4-5-20250929:claude-3-5-sonnet-latest"；
+    # 配置文件中也可以直接写 JSON 对象
+    if (raw or "").lstrip().startswith("{"):
+        return {str(k): str(v) for k, v in _parse_json_object(raw, "MODEL_ALIASES").items() if k and v}
+    aliases: Dict[str, str] = {}
+    for pair in filter(None, (s.strip() for s in (raw or "").split(","))):
+        if ":" in pair:
+            src, dst = pair.split(":", 1)
+            if src.strip() and dst.strip():
+                aliases[src.strip()] = dst.strip()
+    return aliases
+
+
+def _parse_json_object(raw: str, name: str) -> Dict[str, Any]:
+    raw = (raw or "").strip()
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+    except Exception as exc:
+        print(f"⚠️ {name} parse error: {exc}")
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def _files_url_for(api_url: str) -> str:
+    """Files API endpoint next to the Messages endpoint (…/v1/messages?beta=true -> …/v1/files?beta=true)."""
+    parsed = urlparse(api_url)
+    base = parsed.path[:-len('/messages')] if parsed.path.endswith('/messages') else parsed.path.rstrip('/')
+    return urlunparse(parsed._replace(path=base + '/files'))
 
-# 默认模型可通过环境变量覆盖
-DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "claude-3-5-sonnet-latest")
 
-# 允许在环境中配置模型别名映射（逗号分隔的 from:to 列表）
-# 例如：MODEL_ALIASES="claude-sonnet-4-5-20250929:claude-3-5-sonnet-latest"
-RAW_MODEL_ALIASES = os.getenv("MODEL_ALIASES", "")
-MODEL_ALIASES: Dict[str, str] = {}
-for pair in filter(None, (s.strip() for s in RAW_MODEL_ALIASES.split(","))):
-    if ":" in pair:
-        src, dst = pair.split(":", 1)
-        if src.strip() and dst.strip():
-            MODEL_ALIASES[src.strip()] = dst.strip()
+UPSTREAM_API_KEY_PLACEHOLDER = "cr_set_upstream_api_key"
+REQUEST_TIMEOUT_HEADERS = ('X-Request-Timeout', 'X-Stainless-Timeout')
 
-DEFAULT_SYSTEM_PROMPT = os.getenv(
-    "DEFAULT_SYSTEM_PROMPT",
-    "You are Claude Code, Anthropic's official CLI for Claude."
-)
-# Default outbound max tokens (upper bound). Many upstreams reject very large values.
-# Keep a conservative default to avoid 5xx from vendors that cannot honor huge outputs.
-DEFAULT_MAX_TOKENS = int(os.getenv("DEFAULT_MAX_TOKENS", 4096))
-# Optional hard ceiling regardless of request/body; can be raised via env if your upstream allows it.
-MAX_TOKENS_HARD_LIMIT = int(os.getenv("MAX_TOKENS_HARD_LIMIT", 16384))
- 
-# Dynamic max_tokens settings
-def _strtobool(val: Optional[str]) -> bool:
-    if val is None:
-        return False
-    return str(val).strip().lower() in {"1", "true", "yes", "y", "on"}
 
-MAX_TOKENS_DYNAMIC = _strtobool(os.getenv("MAX_TOKENS_DYNAMIC", "false"))
-TOKEN_EST_CHARS_PER_TOKEN = float(os.getenv("TOKEN_EST_CHARS_PER_TOKEN", "4.0"))  # ~4 chars per token heuristic
-IMAGE_TOKEN_EQUIV = int(os.getenv("IMAGE_TOKEN_EQUIV", "256"))  # rough cost per image block when estimating
-DYNAMIC_SAFETY_MARGIN = int(os.getenv("DYNAMIC_SAFETY_MARGIN", "1024"))  # headroom to avoid hitting context limit
-
-# Optional per-model context window limits, JSON, e.g.: {"claude-3-5-sonnet-latest":200000}
-try:
-    _MODEL_CONTEXT_LIMITS_JSON = os.getenv("MODEL_CONTEXT_LIMITS_JSON", "").strip()
-    MODEL_CONTEXT_LIMITS = json.loads(_MODEL_CONTEXT_LIMITS_JSON) if _MODEL_CONTEXT_LIMITS_JSON else {}
-    if not isinstance(MODEL_CONTEXT_LIMITS, dict):
-        MODEL_CONTEXT_LIMITS = {}
-except Exception:
-    MODEL_CONTEXT_LIMITS = {}
-DEFAULT_PROXY_URL = os.getenv("DEFAULT_PROXY_URL", "http://127.0.0.1:7890")
-UPSTREAM_PROXY_URL = os.getenv("UPSTREAM_PROXY_URL")
-MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 5 * 1024 * 1024))
-IMAGE_FETCH_TIMEOUT = int(os.getenv("IMAGE_FETCH_TIMEOUT", 15))
-
-
-def build_proxy_config():
+class ProxyConfig:
+    """One immutable snapshot of every env-driven setting.
+
+    Built from the process environment overlaid with the optional PROXY_CONFIG_FILE
+    (a JSON object keyed by the same variable names). Reloads build a new snapshot
+    and swap it in as a whole, so a request never sees a half-applied change.
+    """
+
+    def __init__(self, source: Mapping[str, str]):
+        def get(name: str, default: Any = None) -> Any:
+            value = source.get(name)
+            return default if value is None else value
+
+        # 上游 Claude 兼容 API（fizzlycode 兼容层）
+        self.api_url = get("UPSTREAM_API_URL", "https://fizzlycode.com/api/v1/messages?beta=true")
+        # 上游鉴权（务必通过环境变量覆盖默认值）
+        self.upstream_api_key = get("UPSTREAM_API_KEY", UPSTREAM_API_KEY_PLACEHOLDER)
+        # 代理自身鉴权（给你的客户端用）
+        self.allowed_api_keys = _parse_allowed_api_keys(get("ALLOWED_API_KEYS", "sk-test123,sk-test456"))
+        self.default_model = get("DEFAULT_MODEL", "claude-3-5-sonnet-latest")
+        self.model_aliases = _parse_model_aliases(get("MODEL_ALIASES", ""))
+        self.default_system_prompt = get(
+            "DEFAULT_SYSTEM_PROMPT",
+            "You are Claude Code, Anthropic's official CLI for Claude."
+        )
+
+        # Default outbound max tokens (upper bound). Many upstreams reject very large values.
+        # Keep a conservative default to avoid 5xx from vendors that cannot honor huge outputs.
+        self.default_max_tokens = int(get("DEFAULT_MAX_TOKENS", 4096))
+        # Optional hard ceiling regardless of request/body; can be raised via env if your upstream allows it.
+        self.max_tokens_hard_limit = int(get("MAX_TOKENS_HARD_LIMIT", 16384))
+        # Dynamic max_tokens settings
+        self.max_tokens_dynamic = _strtobool(get("MAX_TOKENS_DYNAMIC", "false"))
+        self.token_est_chars_per_token = float(get("TOKEN_EST_CHARS_PER_TOKEN", "4.0"))  # ~4 chars per token heuristic
+        self.image_token_equiv = int(get("IMAGE_TOKEN_EQUIV", "256"))  # rough cost per image block when estimating
+        self.dynamic_safety_margin = int(get("DYNAMIC_SAFETY_MARGIN", "1024"))  # headroom to avoid hitting context limit
+        # Token estimator: "calibrated" (char-class counting + online calibration from upstream usage) or "heuristic" (flat chars/token)
+        self.token_estimator = get("TOKEN_ESTIMATOR", "calibrated").strip().lower()
+        self.token_est_cache_size = int(get("TOKEN_EST_CACHE_SIZE", "4096"))  # memoized text segments (per process)
+        self.token_calibration_alpha = float(get("TOKEN_CALIBRATION_ALPHA", "0.2"))  # EMA weight of each upstream observation
+        # Optional per-model context window limits, JSON, e.g.: {"claude-3-5-sonnet-latest":200000}
+        self.model_context_limits = _parse_json_object(get("MODEL_CONTEXT_LIMITS_JSON", ""), "MODEL_CONTEXT_LIMITS_JSON")
+
+        self.default_proxy_url = get("DEFAULT_PROXY_URL", "http://127.0.0.1:7890")
+        self.upstream_proxy_url = get("UPSTREAM_PROXY_URL")
+        # 上游超时：连接超时、非流式读超时、流式事件间空闲超时（0 表示不启用看门狗）
+        self.upstream_connect_timeout = float(get("UPSTREAM_CONNECT_TIMEOUT", "10"))
+        self.nonstream_timeout = float(get("NONSTREAM_TIMEOUT", "120"))
+        self.stream_idle_timeout = float(get("STREAM_IDLE_TIMEOUT", "120"))
+        # 长时间思考时向客户端发送 SSE 注释帧，避免中间层断开连接（0 表示关闭）
+        self.stream_keepalive_interval = float(get("STREAM_KEEPALIVE_INTERVAL", "15"))
+        # 非流式客户端请求也以流式调用上游并增量聚合，避免长输出撞上固定读超时
+        self.upstream_always_stream = _strtobool(get("UPSTREAM_ALWAYS_STREAM", "false"))
+        # 单次请求的总时长上限（秒，0 表示不限）；客户端可用 X-Request-Timeout / X-Stainless-Timeout 头收紧
+        self.request_max_duration = float(get("REQUEST_MAX_DURATION", "0"))
+        # 提前于客户端超时结束，确保客户端能收到干净的错误而不是自己断开
+        self.request_deadline_margin = float(get("REQUEST_DEADLINE_MARGIN", "1.0"))
+        # HTTP/1.1 连接池（复用 keep-alive 连接，避免每个请求都重新握手）
+        self.upstream_pool_size = int(get("UPSTREAM_POOL_SIZE", "64"))
+        # 可选 HTTP/2 传输：多个并发请求复用少量连接
+        self.upstream_http2 = _strtobool(get("UPSTREAM_HTTP2", "false"))
+        self.upstream_http2_connections = int(get("UPSTREAM_HTTP2_CONNECTIONS", "2"))  # 每个上游 host 的连接数
+        self.upstream_http2_max_streams = int(get("UPSTREAM_HTTP2_MAX_STREAMS", "100"))  # 每个连接的最大并发流
+        # 明文 http:// 上游默认只走 HTTP/1.1；设为 true 时按 h2c prior knowledge 直连
+        self.upstream_http2_prior_knowledge = _strtobool(get("UPSTREAM_HTTP2_PRIOR_KNOWLEDGE", "false"))
+        # 压缩：客户端请求体可带 Content-Encoding（gzip/deflate/zstd），解压后的大小上限防止解压炸弹
+        self.max_decompressed_body_bytes = int(get("MAX_DECOMPRESSED_BODY_BYTES", 64 * 1024 * 1024))
+        # 非流式响应按 Accept-Encoding 协商压缩（小于阈值的响应不压缩）
+        self.response_compression = _strtobool(get("RESPONSE_COMPRESSION", "true"))
+        self.compression_min_bytes = int(get("COMPRESSION_MIN_BYTES", "1024"))
+        self.gzip_level = int(get("GZIP_LEVEL", "5"))
+        self.zstd_level = int(get("ZSTD_LEVEL", "3"))
+        # 上游请求体压缩（gzip/zstd，留空关闭）；上游返回 415 时自动退回未压缩并记住该上游
+        self.upstream_request_encoding = get("UPSTREAM_REQUEST_ENCODING", "").strip().lower()
+        # 用量账本：按客户端 key 记录每个请求的 token/延迟，批量异步落盘（路径为空则关闭；仅启动时生效）
+        self.usage_ledger_path = get("USAGE_LEDGER_PATH", "").strip()
+        # sqlite 或 jsonl；默认按扩展名判断（.jsonl/.ndjson 为 jsonl，其余为 sqlite）
+        self.usage_ledger_format = get("USAGE_LEDGER_FORMAT", "").strip().lower()
+        self.usage_ledger_flush_interval = float(get("USAGE_LEDGER_FLUSH_INTERVAL", "1.0"))
+        self.usage_ledger_batch_size = int(get("USAGE_LEDGER_BATCH_SIZE", "256"))
+        self.usage_ledger_max_pending = int(get("USAGE_LEDGER_MAX_PENDING", "50000"))  # 超出后丢弃新记录并计数
+        # 流量采集（性能测试用）：脱敏请求体 + 上游 SSE 时序写入 JSONL，供 bench_proxy.py replay 回放（路径仅启动时生效）
+        self.capture_path = get("CAPTURE_PATH", "").strip()
+        self.capture_sample_rate = float(get("CAPTURE_SAMPLE_RATE", "1.0"))
+        # 管理接口（/admin/usage）的访问 key，与客户端 key 分开；为空时管理接口关闭
+        self.admin_api_keys = _parse_allowed_api_keys(get("ADMIN_API_KEYS", ""))
+
+        self.max_image_bytes = int(get("MAX_IMAGE_BYTES", 5 * 1024 * 1024))
+        # 大图片的 base64 直接引用客户端请求里的字符串，上游请求体分块流式发送，不再整份复制
+        self.lean_request_bodies = _strtobool(get("LEAN_REQUEST_BODIES", "true"))
+        self.image_fetch_timeout = int(get("IMAGE_FETCH_TIMEOUT", 15))
+        # 图片按内容哈希上传到上游 Files API，之后的请求用 file_id 引用，多轮对话不再重复发送同一张图
+        self.image_file_uploads = _strtobool(get("IMAGE_FILE_UPLOADS", "false"))
+        self.upstream_files_url = get("UPSTREAM_FILES_URL", "").strip() or _files_url_for(self.api_url)
+        self.image_file_min_bytes = int(get("IMAGE_FILE_MIN_BYTES", 32 * 1024))  # 更小的图片内联发送更划算
+        self.image_file_ttl = float(get("IMAGE_FILE_TTL", "3600"))  # file_id 缓存有效期（秒），过期后重新上传
+        self.image_file_cache_size = int(get("IMAGE_FILE_CACHE_SIZE", "1024"))  # 仅启动时生效
+        # 图片预处理（需要 Pillow）：限制最长边并重新编码，减少上传体积和图片 token
+        self.image_preprocess = _strtobool(get("IMAGE_PREPROCESS", "false"))
+        self.image_max_dimension = int(get("IMAGE_MAX_DIMENSION", "1568"))
+        self.image_reencode_format = get("IMAGE_REENCODE_FORMAT", "webp").strip().lower()
+        self.image_reencode_quality = int(get("IMAGE_REENCODE_QUALITY", "85"))
+
+        # 上游兼容层常用头，允许通过环境变量自定义/禁用
+        headers: Dict[str, str] = {
+            'accept': 'application/json',
+            'anthropic-version': get('UPSTREAM_ANTHROPIC_VERSION', '2023-06-01'),
+            # 某些 fizzlycode 部署要求带 beta/streaming 标记，否则会 5xx/降级
+            'anthropic-beta': get(
+                'UPSTREAM_ANTHROPIC_BETA',
+                'interleaved-thinking-2025-05-14,fine-grained-tool-streaming-2025-05-14'
+            ),
+            'anthropic-dangerous-direct-browser-access': get('UPSTREAM_ANTHROPIC_DANGEROUS', 'true'),
+            'content-type': 'application/json; charset=utf-8',
+            'user-agent': get('UPSTREAM_USER_AGENT', 'claude-cli/2.0.25 (external, proxy)'),
+            'x-app': get('UPSTREAM_X_APP', 'cli'),
+        }
+        # 允许用户通过 JSON 字符串追加/覆盖/删除（值为空或 null 即视为删除）
+        for key, value in _parse_json_object(get('UPSTREAM_EXTRA_HEADERS_JSON', ''), 'UPSTREAM_EXTRA_HEADERS_JSON').items():
+            if value in ('', None):
+                headers.pop(key, None)
+            else:
+                headers[key] = str(value)
+        # 清理空值，避免发送空头
+        self.upstream_headers = {k: v for k, v in headers.items() if v}
+
+    def warn_if_incomplete(self) -> None:
+        if self.upstream_api_key == UPSTREAM_API_KEY_PLACEHOLDER:
+            print("⚠️ 未检测到 UPSTREAM_API_KEY 环境变量，默认占位值会导致上游 401。请在部署前设置真实值。")
+        if not self.allowed_api_keys:
+            print("⚠️ ALLOWED_API_KEYS 为空，所有请求都会被拒绝。请配置允许访问的客户端 key。")
+        if self.image_preprocess and _optional_import('PIL.Image') is None:
+            print("⚠️ IMAGE_PREPROCESS=true 但未安装 Pillow（pip install Pillow），图片将原样转发。")
+        if self.upstream_request_encoding not in ('', 'gzip', 'zstd'):
+            print(f"⚠️ UPSTREAM_REQUEST_ENCODING={self.upstream_request_encoding} 不受支持（可选 gzip/zstd），上游请求体不压缩。")
+        elif self.upstream_request_encoding == 'zstd' and _optional_import('zstandard') is None:
+            print("⚠️ UPSTREAM_REQUEST_ENCODING=zstd 但未安装 zstandard（pip install zstandard），上游请求体不压缩。")
+
+    @property
+    def proxies(self) -> Optional[Dict[str, str]]:
+        return build_proxy_config(self)
+
+
+# 代理探测在后台线程进行，不阻塞 worker 启动；首个上游请求最多等待一次探测超时
+PROXY_PROBE_TIMEOUT = 0.5
+_PROXY_PROBES: Dict[str, Dict[str, Any]] = {}
+_PROXY_PROBES_LOCK = threading.Lock()
+
+
+def _start_proxy_probe(url: str) -> Dict[str, Any]:
+    with _PROXY_PROBES_LOCK:
+        probe = _PROXY_PROBES.get(url)
+        if probe is not None:
+            return probe
+        probe = {'done': threading.Event(), 'reachable': False}
+        _PROXY_PROBES[url] = probe
+
+    def _probe() -> None:
+        parsed = urlparse(url)
+        try:
+            with socket.create_connection((parsed.hostname, parsed.port), timeout=PROXY_PROBE_TIMEOUT):
+                probe['reachable'] = True
+                print(f"🛜 Detected proxy at {url}")
+        except OSError:
+            print(f"ℹ️ Proxy {url} unreachable, calling upstream directly")
+        finally:
+            probe['done'].set()
+
+    threading.Thread(target=_probe, name='proxy-probe', daemon=True).start()
+    return probe
+
+
+def build_proxy_config(cfg: ProxyConfig, wait: bool = True) -> Optional[Dict[str, str]]:
     """Return proxy configuration if reachable, otherwise None."""
     def _format_proxy(url: str):
         return {'http': url, 'https': url}
 
-    if UPSTREAM_PROXY_URL is not None:
-        cleaned = UPSTREAM_PROXY_URL.strip()
-        if cleaned:
-            print(f"🛜 Using explicit proxy {cleaned}")
-            return _format_proxy(cleaned)
-        print("ℹ️ UPSTREAM_PROXY_URL is empty, proxy disabled")
-        return None
+    if cfg.upstream_proxy_url is not None:
+        cleaned = cfg.upstream_proxy_url.strip()
+        return _format_proxy(cleaned) if cleaned else None
 
-    if not DEFAULT_PROXY_URL:
+    if not cfg.default_proxy_url:
         return None
 
-    parsed = urlparse(DEFAULT_PROXY_URL)
-    host, port = parsed.hostname, parsed.port
-    if not host or not port:
+    parsed = urlparse(cfg.default_proxy_url)
+    if not parsed.hostname or not parsed.port:
         return None
 
-    try:
-        with socket.create_connection((host, port), timeout=0.5):
-            print(f"🛜 Detected proxy at {DEFAULT_PROXY_URL}")
-            return _format_proxy(DEFAULT_PROXY_URL)
-    except OSError:
-        print(f"ℹ️ Proxy {DEFAULT_PROXY_URL} unreachable, calling upstream directly")
-        return None
+    probe = _start_proxy_probe(cfg.default_proxy_url)
+    if wait:
+        probe['done'].wait(PROXY_PROBE_TIMEOUT + 0.1)
+    return _format_proxy(cfg.default_proxy_url) if probe['reachable'] else None
 
 
-PROXIES = build_proxy_config()
-
-# 上游兼容层常用头，允许通过环境变量自定义/禁用
-UPSTREAM_HEADERS_BASE: Dict[str, str] = {
-    'accept': 'application/json',
-    'anthropic-version': os.getenv('UPSTREAM_ANTHROPIC_VERSION', '2023-06-01'),
-    # 某些 fizzlycode 部署要求带 beta/streaming 标记，否则会 5xx/降级
-    'anthropic-beta': os.getenv(
-        'UPSTREAM_ANTHROPIC_BETA',
-        'interleaved-thinking-2025-05-14,fine-grained-tool-streaming-2025-05-14'
-    ),
-    'anthropic-dangerous-direct-browser-access': os.getenv(
-        'UPSTREAM_ANTHROPIC_DANGEROUS', 'true'
-    ),
-    'content-type': 'application/json; charset=utf-8',
-    'user-agent': os.getenv('UPSTREAM_USER_AGENT', 'claude-cli/2.0.25 (external, proxy)'),
-    'x-app': os.getenv('UPSTREAM_X_APP', 'cli'),
-}
+# 可选配置文件（JSON，键与环境变量同名，覆盖环境变量）；修改后自动热加载
+PROXY_CONFIG_FILE = os.getenv("PROXY_CONFIG_FILE", "").strip()
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "2"))
+
 
-# 允许用户通过 JSON 字符串追加/覆盖/删除（值为空或 null 即视为删除）
-_extra_headers_raw = os.getenv('UPSTREAM_EXTRA_HEADERS_JSON', '').strip()
-if _extra_headers_raw:
+def load_config() -> ProxyConfig:
+    source: Dict[str, str] = dict(os.environ)
+    if PROXY_CONFIG_FILE:
+        with open(PROXY_CONFIG_FILE, 'r', encoding='utf-8') as fh:
+            overrides = json.load(fh)
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{PROXY_CONFIG_FILE} must contain a JSON object")
+        for key, value in overrides.items():
+            if value is None:
+                source.pop(key, None)
+            else:
+                source[key] = value if isinstance(value, str) else json.dumps(value)
+    cfg = ProxyConfig(source)
+    # 提前在后台开始代理探测，请求到来时结果通常已就绪
+    build_proxy_config(cfg, wait=False)
+    return cfg
+
+
+CONFIG = load_config()
+CONFIG.warn_if_incomplete()
+if CONFIG.upstream_proxy_url is not None:
+    print(f"🛜 Using explicit proxy {CONFIG.upstream_proxy_url.strip()}" if CONFIG.upstream_proxy_url.strip()
+          else "ℹ️ UPSTREAM_PROXY_URL is empty, proxy disabled")
+_CONFIG_LOCK = threading.Lock()
+
+
+def current_config() -> ProxyConfig:
+    """Config snapshot for the current request (pinned on first use), or the latest one.
+
+    Streaming generators run after the view returns; they are wrapped in
+    stream_with_context so they keep seeing the request's snapshot.
+    """
+    if has_request_context():
+        cfg = g.get('proxy_config')
+        if cfg is None:
+            cfg = g.proxy_config = CONFIG
+        return cfg
+    return CONFIG
+
+
+def reload_config(reason: str) -> bool:
+    """Rebuild the config and swap it in; on any error the previous config stays active."""
+    global CONFIG
+    started = time.perf_counter()
     try:
-        _extra = json.loads(_extra_headers_raw)
-        if isinstance(_extra, dict):
-            for _k, _v in _extra.items():
-                if _v in ('', None):
-                    UPSTREAM_HEADERS_BASE.pop(_k, None)
-                else:
-                    UPSTREAM_HEADERS_BASE[_k] = str(_v)
-    except Exception as _exc:
-        print(f"⚠️ UPSTREAM_EXTRA_HEADERS_JSON parse error: {_exc}")
+        new_config = load_config()
+    except Exception as exc:  # noqa: BLE001 - keep serving with the old config
+        print(f"⚠️ Config reload ({reason}) failed, keeping previous config: {exc}")
+        return False
+    with _CONFIG_LOCK:
+        CONFIG = new_config
+    new_config.warn_if_incomplete()
+    print(f"🔁 Config reloaded ({reason}) in {(time.perf_counter() - started) * 1000:.1f}ms")
+    return True
+
+
+def _watch_config_file() -> None:
+    def _signature() -> Optional[tuple]:
+        try:
+            stat = os.stat(PROXY_CONFIG_FILE)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
 
-# 清理空值，避免发送空头
-UPSTREAM_HEADERS_BASE = {k: v for k, v in UPSTREAM_HEADERS_BASE.items() if v}
+    last = _signature()
+    while True:
+        time.sleep(CONFIG_RELOAD_INTERVAL)
+        current = _signature()
+        if current != last and current is not None:
+            last = current
+            reload_config('file changed')
+
+
+_RELOAD_TRIGGERS_INSTALLED = False
+
+
+def install_reload_triggers() -> None:
+    """Start the config-file watcher and route SIGHUP to reload_config, once per process.
+
+    Called from the server start-up path, not at import: under `gunicorn --preload` the
+    import happens in the master, which handles SIGHUP itself and whose threads do not
+    survive the fork. gunicorn.conf.py calls it from post_worker_init in every worker.
+    """
+    global _RELOAD_TRIGGERS_INSTALLED
+    if _RELOAD_TRIGGERS_INSTALLED:
+        return
+    _RELOAD_TRIGGERS_INSTALLED = True
+    if PROXY_CONFIG_FILE and CONFIG_RELOAD_INTERVAL > 0:
+        threading.Thread(target=_watch_config_file, name='config-watcher', daemon=True).start()
+    if hasattr(signal, 'SIGHUP'):
+        try:
+            # 信号处理函数里只启动线程，避免在持锁/IO 中途重入
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+                target=reload_config, args=('SIGHUP',), name='config-reload', daemon=True
+            ).start())
+            # 不打断进行中的系统调用（例如正在读上游流的 socket）
+            signal.siginterrupt(signal.SIGHUP, False)
+        except ValueError:
+            # 不在主线程调用（例如嵌入到其他服务中）时无法注册信号，仅保留文件监听
+            pass
 
 
 def _guess_media_type(source: str, fallback: str = "application/octet-stream") -> str:
@@ -174,32 +420,149 @@ def _guess_media_type(source: str, fallback: str = "application/octet-stream") -
     return media_type or fallback
 
 
-def _encode_data_url(data_url: str) -> Dict[str, str]:
+_REENCODE_MEDIA_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+# Anthropic 文档给出的图片 token 估算：宽 × 高 / 750
+IMAGE_PIXELS_PER_TOKEN = 750
+# 小于该长度的 base64 直接切片复制，开销可以忽略
+INLINE_VIEW_MIN_CHARS = 64 * 1024
+# 无需 JSON 转义的 base64 字符；含换行等其他字符的载荷按普通字符串处理
+_BASE64_TEXT_RE = re.compile(r'[A-Za-z0-9+/=]*')
+
+
+class InlineBase64:
+    """Base64 payload that lives inside a larger string (e.g. a data: URL), referenced instead of sliced out.
+
+    Only StreamedJsonBody knows how to serialize it; it is written upstream in
+    chunks straight from the client's string.
+    """
+
+    __slots__ = ('source', 'start')
+
+    def __init__(self, source: str, start: int = 0):
+        self.source = source
+        self.start = start
+
+    def __len__(self) -> int:
+        return len(self.source) - self.start
+
+    def chunks(self, size: int) -> Iterator[bytes]:
+        for offset in range(self.start, len(self.source), size):
+            yield self.source[offset:offset + size].encode('ascii')
+
+
+def inline_base64(source: str, start: int = 0) -> Any:
+    """Return source[start:] as a shared InlineBase64 when it is large, plain base64 and lean bodies are on."""
+    if (current_config().lean_request_bodies and len(source) - start >= INLINE_VIEW_MIN_CHARS
+            and _BASE64_TEXT_RE.fullmatch(source, start)):
+        return InlineBase64(source, start)
+    return source[start:] if start else source
+
+
+def _share_inline_payloads(content: Any) -> None:
+    """Swap large base64 image/document payloads of an Anthropic request for InlineBase64 views, in place."""
+    if isinstance(content, list):
+        for item in content:
+            _share_inline_payloads(item)
+    elif isinstance(content, dict):
+        source = content.get('source')
+        if (content.get('type') in ('image', 'document') and isinstance(source, dict)
+                and source.get('type') == 'base64' and isinstance(source.get('data'), str)):
+            source['data'] = inline_base64(source['data'])
+        else:
+            _share_inline_payloads(content.get('content'))
+
+
+def _preprocess_image(raw: Any, media_type: str) -> Optional[Dict[str, Any]]:
+    """Downsize and re-encode an image when that makes it smaller.
+
+    Returns None when preprocessing is disabled or the image cannot be decoded.
+    Otherwise returns the final pixel size, plus `data` (base64) / `media_type`
+    only if the re-encoded image replaces the original.
+    """
+    cfg = current_config()
+    Image = _optional_import('PIL.Image') if cfg.image_preprocess else None
+    if Image is None:
+        return None
+    target_format = cfg.image_reencode_format if cfg.image_reencode_format in _REENCODE_MEDIA_TYPES else 'webp'
     try:
-        header, encoded = data_url.split(',', 1)
-        meta = header.split(';')
-        media_type = meta[0][5:] if meta[0].startswith('data:') else 'application/octet-stream'
+        with Image.open(io.BytesIO(raw)) as img:
+            width, height = img.size
+            if getattr(img, 'is_animated', False):
+                # 动图重新编码会丢帧，保持原样
+                return {'width': width, 'height': height}
+            bound = cfg.image_max_dimension if cfg.image_max_dimension > 0 else max(width, height)
+            resized = max(width, height) > bound
+            if resized:
+                # JPEG 可以在解码阶段直接按比例缩小，省下全尺寸位图的内存
+                img.draft('RGB', (bound, bound))
+                img.thumbnail((bound, bound), Image.LANCZOS)
+            if target_format == 'jpeg' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                img = img.convert('RGBA')
+            out = io.BytesIO()
+            img.save(out, format=target_format.upper(), quality=cfg.image_reencode_quality)
+            result: Dict[str, Any] = {'width': img.size[0], 'height': img.size[1]}
+            # 位图（缩放/转换后可能是另一个对象，with 不会关闭它）立即释放，不与后面的 base64 同时占用内存
+            img.close()
+    except Exception as exc:  # noqa: BLE001 - fall back to the original bytes
+        print(f"⚠️ Image preprocess skipped: {exc}")
+        return None
+
+    if not resized and out.tell() >= len(raw):
+        return {'width': width, 'height': height}
+    print(f"🖼️ Image {width}x{height} {len(raw)}B -> {result['width']}x{result['height']} {out.tell()}B {target_format}")
+    # 直接对 BytesIO 的缓冲区做 base64；缓冲区在生成字符串之前关闭，bytes 结果转成字符串后立即释放，
+    # 返回时只剩一份 base64 字符串
+    with out:
+        encoded = base64.b64encode(out.getbuffer())
+    result['media_type'] = _REENCODE_MEDIA_TYPES[target_format]
+    result['data'] = encoded.decode('ascii')
+    del encoded
+    return result
+
+
+def _finish_image_source(raw: Any, media_type: str, encoded: Optional[str]) -> Dict[str, str]:
+    """Apply optional preprocessing and return the base64 image source."""
+    processed = _preprocess_image(raw, media_type)
+    if processed and 'data' in processed:
+        media_type, encoded = processed['media_type'], processed['data']
+    elif encoded is None:
+        encoded = base64.b64encode(raw).decode('ascii')
+    if processed:
+        _remember_image_tokens(encoded, processed['width'] * processed['height'] / IMAGE_PIXELS_PER_TOKEN)
+    return {'media_type': media_type, 'data': encoded}
+
+
+def _encode_data_url(data_url: str) -> Dict[str, Any]:
+    cfg = current_config()
+    try:
+        comma = data_url.index(',')
+        meta = data_url[:comma].split(';')
+        media_type = (meta[0][5:] if meta[0].startswith('data:') else '') or 'application/octet-stream'
         if 'base64' in meta:
-            return {
-                'media_type': media_type or 'application/octet-stream',
-                'data': encoded
-            }
+            if cfg.image_preprocess and _optional_import('PIL.Image') is not None:
+                encoded = data_url[comma + 1:]
+                return _finish_image_source(base64.b64decode(encoded), media_type, encoded)
+            # 不切片：大图片直接引用客户端的 data URL 字符串
+            return {'media_type': media_type, 'data': inline_base64(data_url, comma + 1)}
         return {
-            'media_type': media_type or 'application/octet-stream',
-            'data': base64.b64encode(encoded.encode('utf-8')).decode('ascii')
+            'media_type': media_type,
+            'data': base64.b64encode(data_url[comma + 1:].encode('utf-8')).decode('ascii')
         }
     except Exception as exc:  # noqa: BLE001 - provide user-facing error
         raise ValueError(f"无法解析 data URL：{exc}")
 
 
 def _download_image(url: str) -> Dict[str, str]:
+    cfg = current_config()
     headers = {'User-Agent': 'claude-proxy/1.0'}
     try:
         resp = requests.get(
             url,
             stream=True,
-            timeout=IMAGE_FETCH_TIMEOUT,
-            proxies=PROXIES,
+            timeout=cfg.image_fetch_timeout,
+            proxies=cfg.proxies,
             headers=headers
         )
     except requests.RequestException as exc:  # noqa: BLE001
@@ -215,15 +578,14 @@ def _download_image(url: str) -> Dict[str, str]:
         if not chunk:
             continue
         total += len(chunk)
-        if total > MAX_IMAGE_BYTES:
-            raise ValueError(f"图片大小超过限制 {MAX_IMAGE_BYTES // (1024 * 1024)}MB")
+        if total > cfg.max_image_bytes:
+            raise ValueError(f"图片大小超过限制 {cfg.max_image_bytes // (1024 * 1024)}MB")
         data.extend(chunk)
 
     if total == 0:
         raise ValueError("下载图片失败：内容为空")
 
-    encoded = base64.b64encode(data).decode('ascii')
-    return {'media_type': content_type, 'data': encoded}
+    return _finish_image_source(data, content_type, None)
 
 
 def _image_block_from_part(part: Dict[str, Any]) -> Dict[str, Any]:
@@ -270,10 +632,11 @@ def _clamp_max_tokens(model: str, requested: Optional[int]) -> int:
     instead of a clean 4xx when `max_tokens` is too large. To make the proxy resilient,
     we cap the value using a conservative hard limit that can be tuned via env.
     """
-    # Start with defaults; prefer explicit request, then DEFAULT_MAX_TOKENS
-    desired = requested or DEFAULT_MAX_TOKENS
+    cfg = current_config()
+    # Start with defaults; prefer explicit request, then cfg.default_max_tokens
+    desired = requested or cfg.default_max_tokens
     # Hard cap
-    cap = MAX_TOKENS_HARD_LIMIT if MAX_TOKENS_HARD_LIMIT > 0 else 8192
+    cap = cfg.max_tokens_hard_limit if cfg.max_tokens_hard_limit > 0 else 8192
     if desired > cap:
         print(f"🔧 max_tokens clamped from {desired} -> {cap} for model '{model}'")
         return cap
@@ -282,58 +645,233 @@ def _clamp_max_tokens(model: str, requested: Optional[int]) -> int:
 
 def _get_model_context_limit(model: str) -> Optional[int]:
     # Exact match first, then alias-insensitive fallback
-    if model in MODEL_CONTEXT_LIMITS:
-        return int(MODEL_CONTEXT_LIMITS[model])
-    mapped = MODEL_ALIASES.get(model)
-    if mapped and mapped in MODEL_CONTEXT_LIMITS:
-        return int(MODEL_CONTEXT_LIMITS[mapped])
+    cfg = current_config()
+    if model in cfg.model_context_limits:
+        return int(cfg.model_context_limits[model])
+    mapped = cfg.model_aliases.get(model)
+    if mapped and mapped in cfg.model_context_limits:
+        return int(cfg.model_context_limits[mapped])
     return None
 
 
-def _estimate_input_tokens(anthropic_messages: List[Dict[str, Any]], system_blocks: List[Dict[str, Any]]) -> int:
-    total_chars = 0
+class _LRUCache:
+    """Tiny thread-safe LRU used to memoize per-segment token counts (and cache upstream file ids)."""
+
+    def __init__(self, maxsize: int, on_evict: Optional[Callable[[Any, Any], None]] = None):
+        self.maxsize = max(0, maxsize)
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        if self.on_evict is not None:
+            for item in evicted:
+                self.on_evict(*item)
+
+
+_TOKEN_COUNT_CACHE = _LRUCache(CONFIG.token_est_cache_size)  # 大小仅在启动时生效
+# 短文本直接计算比查缓存更便宜
+_TOKEN_CACHE_MIN_CHARS = 64
+# 每条消息 / 启用工具时上游额外注入的固定开销（经验值）
+TOKENS_PER_MESSAGE = 4
+TOOLS_PREAMBLE_TOKENS = 350
+
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+_WORD_RE = re.compile(r'[A-Za-z]+')
+_DIGIT_RE = re.compile(r'[0-9]')
+_SPACE_RE = re.compile(r'\s')
+
+
+def _heuristic_text_tokens(text: str) -> float:
+    cfg = current_config()
+    chars_per_token = cfg.token_est_chars_per_token if cfg.token_est_chars_per_token > 0 else 4.0
+    return len(text) / chars_per_token
+
+
+def _char_class_text_tokens(text: str) -> float:
+    """Approximate BPE behaviour by character class.
+
+    Latin words cost ~1 token per 4 letters (at least one per word), digits are grouped
+    in pairs, CJK ideographs/kana/hangul cost ~1 token each and punctuation / other
+    symbols (dominant in JSON and code) cost most of a token each.
+    """
+    words = _WORD_RE.findall(text)
+    letters = sum(map(len, words))
+    digits = len(_DIGIT_RE.findall(text))
+    cjk = len(_CJK_RE.findall(text))
+    spaces = len(_SPACE_RE.findall(text))
+    symbols = max(0, len(text) - letters - digits - cjk - spaces)
+    return max(len(words), letters / 4.0) + digits / 2.0 + cjk * 1.1 + symbols * 0.7
+
+
+_TEXT_TOKEN_COUNTERS: Dict[str, Callable[[str], float]] = {
+    'heuristic': _heuristic_text_tokens,
+    'calibrated': _char_class_text_tokens,
+}
+
+
+def _token_cache_key(kind: str, value: str) -> tuple:
+    """Cache key for a text or image segment.
+
+    Built from a real digest rather than ``hash()``: entries store no text, so a
+    64-bit hash collision would silently return another segment's count.
+    """
+    digest = hashlib.blake2b(value.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    return (kind, len(value), digest)
+
+
+def _text_tokens(text: str) -> float:
+    cfg = current_config()
+    counter = _TEXT_TOKEN_COUNTERS.get(cfg.token_estimator, _char_class_text_tokens)
+    if len(text) < _TOKEN_CACHE_MIN_CHARS:
+        return counter(text)
+    # 摘要远比按字符类别计数便宜，重复的历史消息只算一次；缓存里不保留原文
+    key = _token_cache_key(cfg.token_estimator, text)
+    cached = _TOKEN_COUNT_CACHE.get(key)
+    if cached is None:
+        cached = counter(text)
+        _TOKEN_COUNT_CACHE.put(key, cached)
+    return cached
+
+
+def _remember_image_tokens(encoded: str, tokens: float) -> None:
+    """Record the real token cost of a preprocessed image for later estimates."""
+    _TOKEN_COUNT_CACHE.put(_token_cache_key('image', encoded), max(1.0, tokens))
+
+
+def _json_tokens(value: Any) -> float:
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        return _text_tokens(value)
+    return _text_tokens(json.dumps(value, ensure_ascii=False, separators=(',', ':')))
+
+
+def _content_tokens(content: Any) -> float:
+    if content is None:
+        return 0.0
+    if isinstance(content, str):
+        # Anthropic 原生请求允许 content / system 直接是字符串
+        return _text_tokens(content)
+    if isinstance(content, dict):
+        return _block_tokens(content)
+    if isinstance(content, list):
+        return sum(_block_tokens(b) for b in content)
+    return _text_tokens(str(content))
+
+
+def _block_tokens(block: Any) -> float:
+    cfg = current_config()
+    if isinstance(block, str):
+        return _text_tokens(block)
+    if not isinstance(block, dict):
+        return 0.0
+    btype = block.get('type')
+    if btype == 'text':
+        return _text_tokens(block.get('text') or '')
+    if btype == 'image':
+        data = (block.get('source') or {}).get('data')
+        if isinstance(data, str):
+            known = _TOKEN_COUNT_CACHE.get(_token_cache_key('image', data))
+            if known is not None:
+                return known
+        return float(cfg.image_token_equiv)
+    if btype == 'document':
+        return float(cfg.image_token_equiv)
+    if btype == 'tool_use':
+        return _text_tokens(block.get('name') or '') + _json_tokens(block.get('input')) + TOKENS_PER_MESSAGE
+    if btype == 'tool_result':
+        return _content_tokens(block.get('content')) + TOKENS_PER_MESSAGE
+    if btype == 'thinking':
+        return _text_tokens(block.get('thinking') or '')
+    return _json_tokens(block)
+
+
+def _estimate_raw_input_tokens(anthropic_messages: List[Dict[str, Any]], system_blocks: Any, tools: Optional[List[Dict[str, Any]]] = None) -> float:
+    total = _content_tokens(system_blocks)
     for m in anthropic_messages or []:
-        for b in m.get('content', []) or []:
-            btype = b.get('type')
-            if btype == 'text':
-                total_chars += len(b.get('text') or '')
-            elif btype == 'image':
-                total_chars += IMAGE_TOKEN_EQUIV * int(TOKEN_EST_CHARS_PER_TOKEN)
-    for b in system_blocks or []:
-        if b.get('type') == 'text':
-            total_chars += len(b.get('text') or '')
-    if TOKEN_EST_CHARS_PER_TOKEN <= 0:
-        return max(1, total_chars // 4)
-    return max(1, int(total_chars / TOKEN_EST_CHARS_PER_TOKEN))
-
-
-def _apply_dynamic_max_tokens(model: str, requested: Optional[int], anthropic_messages: List[Dict[str, Any]], system_blocks: List[Dict[str, Any]]) -> int:
+        if isinstance(m, dict):
+            total += _content_tokens(m.get('content')) + TOKENS_PER_MESSAGE
+    if tools:
+        total += TOOLS_PREAMBLE_TOKENS + sum(_json_tokens(t) for t in tools)
+    return total
+
+
+# 按模型记录 “上游实际 input_tokens / 本地估算” 的指数滑动平均，用于校准估算
+_TOKEN_CALIBRATION: Dict[str, float] = {}
+_TOKEN_CALIBRATION_LOCK = threading.Lock()
+
+
+def _estimate_input_tokens(anthropic_messages: List[Dict[str, Any]], system_blocks: Any, tools: Optional[List[Dict[str, Any]]] = None, model: Optional[str] = None) -> int:
+    cfg = current_config()
+    raw = _estimate_raw_input_tokens(anthropic_messages, system_blocks, tools)
+    if cfg.token_estimator == 'calibrated' and model:
+        raw *= _TOKEN_CALIBRATION.get(model, 1.0)
+    return max(1, int(raw))
+
+
+def _observe_input_tokens(model: str, anthropic_messages: List[Dict[str, Any]], system_blocks: Any, tools: Optional[List[Dict[str, Any]]], usage: Optional[Dict[str, Any]]) -> None:
+    """Fold an upstream `usage` report into the per-model calibration factor."""
+    cfg = current_config()
+    if cfg.token_estimator != 'calibrated' or not usage:
+        return
+    actual = sum(
+        _coerce_positive_int(usage.get(k)) or 0
+        for k in ('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+    )
+    raw = _estimate_raw_input_tokens(anthropic_messages, system_blocks, tools)
+    if actual <= 0 or raw <= 0:
+        return
+    ratio = min(4.0, max(0.25, actual / raw))
+    with _TOKEN_CALIBRATION_LOCK:
+        previous = _TOKEN_CALIBRATION.get(model)
+        _TOKEN_CALIBRATION[model] = ratio if previous is None else previous + cfg.token_calibration_alpha * (ratio - previous)
+
+
+def _apply_dynamic_max_tokens(model: str, requested: Optional[int], anthropic_messages: List[Dict[str, Any]], system_blocks: Any, tools: Optional[List[Dict[str, Any]]] = None) -> int:
+    cfg = current_config()
     static = _clamp_max_tokens(model, requested)
-    if not MAX_TOKENS_DYNAMIC:
+    if not cfg.max_tokens_dynamic:
         return static
     context_limit = _get_model_context_limit(model)
     if not context_limit:
         return static
-    used = _estimate_input_tokens(anthropic_messages, system_blocks)
-    budget = max(0, context_limit - used - max(0, DYNAMIC_SAFETY_MARGIN))
+    used = _estimate_input_tokens(anthropic_messages, system_blocks, tools, model)
+    budget = max(0, context_limit - used - max(0, cfg.dynamic_safety_margin))
     if budget <= 0:
-        minimal = min(256, MAX_TOKENS_HARD_LIMIT) if MAX_TOKENS_HARD_LIMIT > 0 else 256
+        minimal = min(256, cfg.max_tokens_hard_limit) if cfg.max_tokens_hard_limit > 0 else 256
         print(f"🔧 dynamic budget <= 0 (used={used}, ctx={context_limit}), setting max_tokens={minimal}")
         return minimal
-    dynamic_cap = min(budget, MAX_TOKENS_HARD_LIMIT if MAX_TOKENS_HARD_LIMIT > 0 else budget)
-    desired = requested or DEFAULT_MAX_TOKENS
+    dynamic_cap = min(budget, cfg.max_tokens_hard_limit if cfg.max_tokens_hard_limit > 0 else budget)
+    desired = requested or cfg.default_max_tokens
     final = min(desired, int(dynamic_cap))
     if final != desired:
-        print(f"🔧 dynamic max_tokens adjusted {desired} -> {final} (budget={budget}, cap={MAX_TOKENS_HARD_LIMIT}, model='{model}')")
+        print(f"🔧 dynamic max_tokens adjusted {desired} -> {final} (budget={budget}, cap={cfg.max_tokens_hard_limit}, model='{model}')")
     return max(1, int(final))
 
 
 def _normalize_model_name(model: str) -> str:
     """Map inbound model to upstream-accepted value via env alias map."""
+    cfg = current_config()
     if not model:
-        return DEFAULT_MODEL
+        return cfg.default_model
     # 环境别名优先
-    mapped = MODEL_ALIASES.get(model)
+    mapped = cfg.model_aliases.get(model)
     if mapped:
         return mapped
     return model
@@ -518,11 +1056,12 @@ def _map_stop_reason(reason: Optional[str]) -> str:
 
 
 def _build_stream_chunk(message_id: str, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+    cfg = current_config()
     chunk = {
         'id': message_id,
         'object': 'chat.completion.chunk',
         'created': int(time.time()),
-        'model': DEFAULT_MODEL,
+        'model': cfg.default_model,
         'choices': [{
             'index': 0,
             'delta': delta,
@@ -531,6 +1070,1322 @@ def _build_stream_chunk(message_id: str, delta: Dict[str, Any], finish_reason: O
     }
     return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
 
+
+def _build_usage_chunk(message_id: str, usage: Optional[Dict[str, Any]]) -> bytes:
+    """Final chunk for `stream_options.include_usage`: empty choices plus the request's usage."""
+    cfg = current_config()
+    chunk = {
+        'id': message_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': cfg.default_model,
+        'choices': [],
+        'usage': _openai_usage(usage)
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+def _build_stream_error(message: str, error_type: str = 'timeout_error', code: str = 'upstream_stalled') -> bytes:
+    payload = {'error': {'message': message, 'type': error_type, 'param': None, 'code': code}}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+def _build_upstream_headers() -> Dict[str, str]:
+    cfg = current_config()
+    headers = dict(cfg.upstream_headers)
+    headers['authorization'] = f'Bearer {cfg.upstream_api_key}'
+    return headers
+
+
+# 所有上游调用共享一个 Session，HTTP/1.1 连接在请求之间复用（池大小仅在启动时生效）
+UPSTREAM_SESSION = requests.Session()
+_upstream_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(1, CONFIG.upstream_pool_size))
+UPSTREAM_SESSION.mount('http://', _upstream_adapter)
+UPSTREAM_SESSION.mount('https://', _upstream_adapter)
+
+
+class _Http2Response:
+    """Expose the subset of requests.Response used by the proxy on top of an httpx response."""
+
+    def __init__(self, resp, release: Callable[[bool], None]):
+        self._resp = resp
+        self._release = release
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self._lock = threading.Lock()
+        # 流读到结尾（或读取出错）后 httpcore 已结束这个流，任何线程都可以安全关闭；非流式响应已经读完
+        self._ended = resp.is_closed
+        self._abandoned = False
+
+    def _iter_bytes(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        try:
+            yield from self._resp.iter_bytes(chunk_size)
+        finally:
+            with self._lock:
+                self._ended = True
+                abandoned = self._abandoned
+            if abandoned:
+                # 调用方早已放弃：由正在读这个流的线程自己关闭
+                self._resp.close()
+
+    def iter_content(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        return self._iter_bytes(chunk_size)
+
+    def iter_lines(self, decode_unicode: bool = False) -> Iterator[bytes]:
+        pending = b''
+        for chunk in self._iter_bytes():
+            lines = (pending + chunk).splitlines(keepends=True)
+            pending = lines.pop() if lines and not lines[-1].endswith((b'\n', b'\r')) else b''
+            for line in lines:
+                yield line.rstrip(b'\r\n')
+        if pending:
+            yield pending
+
+    @property
+    def content(self) -> bytes:
+        # 与 requests 一致：读完响应体即归还流（错误响应读取后调用方不会再 close）
+        try:
+            return self._resp.read()
+        finally:
+            # read() 在本线程读到结尾或出错，httpcore 都已结束这个流
+            with self._lock:
+                self._ended = True
+            self.close()
+
+    @property
+    def text(self) -> str:
+        self.content
+        return self._resp.text
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def close(self) -> None:
+        # 没读到结尾就放弃的流：httpcore 不发 RST_STREAM，之后到达的 DATA 帧也不再确认，
+        # 会耗尽整条连接的流控窗口；另一个线程可能还在读它，跨线程关闭会破坏同连接上的其它流。
+        # 所以不碰这个流，只让传输层把连接退役，连接上其余的流结束后整条连接关闭
+        with self._lock:
+            abandoned = not self._ended
+            self._abandoned = abandoned
+        if abandoned:
+            self._release(True)
+            return
+        try:
+            self._resp.close()
+        finally:
+            self._release(False)
+
+
+class _Http2Lane:
+    """One multiplexed HTTP/2 connection with a cap on concurrent streams."""
+
+    def __init__(self, cfg: ProxyConfig):
+        httpx = _optional_import('httpx')
+        proxies = cfg.proxies
+        proxy = proxies.get('https') if proxies else None
+        self.client = httpx.Client(
+            http2=True,
+            http1=not cfg.upstream_http2_prior_knowledge,
+            proxy=proxy,
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        )
+        self.active = 0
+        # 退役的连接不再接新请求，最后一个流归还时关闭
+        self.retired = False
+        # httpcore 公开的 network_stream 扩展：关闭退役连接时先 shutdown，唤醒阻塞在 recv 上的读线程
+        self.network_stream = None
+
+    def close(self) -> None:
+        sock = self.network_stream.get_extra_info('socket') if self.network_stream is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.client.close()
+
+
+class UpstreamSendError(Exception):
+    """The upstream connection failed after the request may already have reached it (not safe to resend)."""
+
+
+class _Http2Transport:
+    """Spread upstream requests over a few HTTP/2 connections per origin."""
+
+    def __init__(self, cfg: ProxyConfig):
+        self._cfg = cfg
+        self._lanes: Dict[str, List[_Http2Lane]] = {}
+        self._retired: Dict[str, List[_Http2Lane]] = {}
+        self._lock = threading.Condition()
+
+    def _acquire(self, origin: str, wait: float) -> Optional[_Http2Lane]:
+        cfg = self._cfg
+        deadline = time.monotonic() + wait
+        with self._lock:
+            lanes = self._lanes.get(origin)
+            if lanes is None:
+                lanes = [_Http2Lane(cfg) for _ in range(max(1, cfg.upstream_http2_connections))]
+                self._lanes[origin] = lanes
+            while True:
+                lane = min(lanes, key=lambda item: item.active)
+                if lane.active < max(1, cfg.upstream_http2_max_streams):
+                    lane.active += 1
+                    return lane
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def _release(self, origin: str, lane: _Http2Lane, abandoned: bool = False) -> None:
+        """Return a stream slot; a lane with an abandoned stream is replaced and closed once it drains.
+
+        An abandoned stream keeps its slot counted only until this call, so "drained" means
+        the lane's other streams have finished. Closing the connection is the only public
+        way to make httpcore give up a stream it is still reading, and it would take those
+        other streams with it, so the lane just stops taking new requests until then.
+        """
+        with self._lock:
+            lane.active -= 1
+            if abandoned and not lane.retired:
+                lane.retired = True
+                lanes = self._lanes.get(origin, [])
+                if lane in lanes:
+                    lanes[lanes.index(lane)] = _Http2Lane(self._cfg)
+                self._retired.setdefault(origin, []).append(lane)
+            drained = lane.retired and lane.active == 0
+            if drained:
+                self._retired[origin].remove(lane)
+            self._lock.notify()
+        if drained:
+            lane.close()
+
+    def post(self, url: str, *, stream: bool, timeout, headers: Dict[str, str], body: Any) -> Optional[_Http2Response]:
+        """Send over HTTP/2; returns None when the caller should fall back to HTTP/1.1.
+
+        Only failures that prove the request never left (connect/proxy errors, pool timeout)
+        fall back. Anything later may have reached the upstream, which would generate and
+        bill the same prompt twice, so it raises UpstreamSendError instead.
+        """
+        httpx = _optional_import('httpx')
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        lane = self._acquire(origin, connect_timeout)
+        if lane is None:
+            print("ℹ️ HTTP/2 lanes saturated, falling back to HTTP/1.1")
+            return None
+        released = False
+
+        def _release_once(abandoned: bool = False) -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._release(origin, lane, abandoned)
+
+        try:
+            req = lane.client.build_request(
+                'POST', url, headers=headers, content=body,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            )
+            resp = lane.client.send(req, stream=stream)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.ProxyError) as exc:
+            _release_once()
+            print(f"⚠️ HTTP/2 upstream failed ({exc}), falling back to HTTP/1.1")
+            return None
+        except httpx.TransportError as exc:
+            _release_once()
+            raise UpstreamSendError(f"HTTP/2 upstream failed after sending the request: {exc!r}") from exc
+        except BaseException:
+            _release_once()
+            raise
+        lane.network_stream = resp.extensions.get('network_stream') or lane.network_stream
+        if not stream:
+            _release_once()
+        return _Http2Response(resp, _release_once)
+
+    def stats(self) -> Dict[str, List[int]]:
+        with self._lock:
+            return {origin: [lane.active for lane in lanes + self._retired.get(origin, [])]
+                    for origin, lanes in self._lanes.items()}
+
+
+# HTTP/2 传输按相关配置缓存；热加载改变这些配置时新建一组连接，旧连接随在途请求结束而闲置
+_HTTP2_TRANSPORTS: Dict[tuple, _Http2Transport] = {}
+_HTTP2_TRANSPORTS_LOCK = threading.Lock()
+
+
+def _get_http2_transport(cfg: ProxyConfig) -> Optional[_Http2Transport]:
+    if not cfg.upstream_http2:
+        return None
+    # httpx 需要 h2 才能启用 http2=True
+    if _optional_import('httpx') is None or _optional_import('h2') is None:
+        return None
+    key = (cfg.upstream_http2_connections, cfg.upstream_http2_max_streams,
+           cfg.upstream_http2_prior_knowledge, cfg.upstream_proxy_url, cfg.default_proxy_url)
+    with _HTTP2_TRANSPORTS_LOCK:
+        transport = _HTTP2_TRANSPORTS.get(key)
+        if transport is None:
+            transport = _HTTP2_TRANSPORTS[key] = _Http2Transport(cfg)
+        return transport
+
+
+if CONFIG.upstream_http2 and (_optional_import('httpx') is None or _optional_import('h2') is None):
+    print('⚠️ UPSTREAM_HTTP2=true 但未安装 httpx[http2]（pip install "httpx[http2]"），使用 HTTP/1.1。')
+
+
+class RequestBodyTooLarge(ValueError):
+    """Decompressed request body exceeds MAX_DECOMPRESSED_BODY_BYTES."""
+
+
+class UnsupportedContentEncoding(ValueError):
+    """Request body uses a Content-Encoding the proxy cannot decode."""
+
+
+def _zstd_available() -> bool:
+    return _optional_import('zstandard') is not None
+
+
+def _inflate(raw: bytes, limit: int) -> bytes:
+    out = bytearray()
+    data = raw
+    while data:
+        # wbits=47 同时接受 gzip 与 zlib 头；多成员 gzip 逐个解压
+        inflater = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        try:
+            out += inflater.decompress(data, limit + 1 - len(out))
+        except zlib.error as exc:
+            raise ValueError(f"invalid compressed body: {exc}") from exc
+        if len(out) > limit:
+            raise RequestBodyTooLarge(f"decompressed body exceeds {limit} bytes")
+        if not inflater.eof:
+            raise ValueError("truncated compressed body")
+        data = inflater.unused_data
+    return bytes(out)
+
+
+def _unzstd(raw: bytes, limit: int) -> bytes:
+    zstandard = _optional_import('zstandard')
+    if zstandard is None:
+        raise UnsupportedContentEncoding("zstd request bodies require the zstandard package")
+    out = bytearray()
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True) as reader:
+            while True:
+                chunk = reader.read(min(256 * 1024, limit + 1 - len(out)))
+                if not chunk:
+                    break
+                out += chunk
+                if len(out) > limit:
+                    raise RequestBodyTooLarge(f"decompressed body exceeds {limit} bytes")
+    except zstandard.ZstdError as exc:
+        raise ValueError(f"invalid zstd body: {exc}") from exc
+    return bytes(out)
+
+
+def decompress_body(raw: bytes, content_encoding: str, limit: int) -> bytes:
+    """Undo a (possibly stacked) Content-Encoding, never producing more than `limit` bytes."""
+    codings = [c.strip().lower() for c in content_encoding.split(',') if c.strip()]
+    # 多重编码按施加顺序列出，解码时倒序
+    for coding in reversed(codings):
+        if coding == 'identity':
+            continue
+        if coding in ('gzip', 'x-gzip', 'deflate'):
+            raw = _inflate(raw, limit)
+        elif coding == 'zstd':
+            raw = _unzstd(raw, limit)
+        else:
+            raise UnsupportedContentEncoding(f"unsupported Content-Encoding: {coding}")
+    return raw
+
+
+def compress_body(data: bytes, encoding: str, cfg: ProxyConfig) -> bytes:
+    if encoding == 'zstd':
+        return _optional_import('zstandard').ZstdCompressor(level=cfg.zstd_level).compress(data)
+    return gzip.compress(data, compresslevel=cfg.gzip_level, mtime=0)
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick zstd or gzip from an Accept-Encoding header (q=0 excludes), None for identity."""
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+    candidates = [('zstd', weights.get('zstd', weights.get('*', 0.0))) if _zstd_available() else ('zstd', 0.0),
+                  ('gzip', weights.get('gzip', weights.get('x-gzip', weights.get('*', 0.0))))]
+    best = max(candidates, key=lambda item: item[1])
+    return best[0] if best[1] > 0 else None
+
+
+JSON_STREAM_CHUNK = 64 * 1024
+
+
+class StreamedJsonBody:
+    """JSON request body whose InlineBase64 payloads are streamed instead of copied into one big buffer.
+
+    The rest of the body is serialized once into a small skeleton. Iterating
+    yields the skeleton pieces with the shared payloads spliced in chunk by
+    chunk, and len() is the exact byte size, so requests/httpx can send a
+    Content-Length without building the payload. Every iteration starts over,
+    which keeps the 415 retry working.
+    """
+
+    def __init__(self, body: Any):
+        nonce = uuid.uuid4().hex
+        views: List[InlineBase64] = []
+
+        def _placeholder(value: Any) -> str:
+            if not isinstance(value, InlineBase64):
+                raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+            views.append(value)
+            return f"\x00inline:{nonce}:{len(views) - 1}\x00"
+
+        skeleton = json.dumps(body, ensure_ascii=False, default=_placeholder).encode('utf-8')
+        # json.dumps 把 \x00 转义为 \u0000，占位符连同引号一起切开
+        pieces = re.split(rb'"\\u0000inline:' + nonce.encode('ascii') + rb':(\d+)\\u0000"', skeleton)
+        self._parts: List[Any] = [views[int(piece)] if i % 2 else piece for i, piece in enumerate(pieces)]
+        self.shared = len(views)
+        self._length = sum(len(part) + (2 if i % 2 else 0) for i, part in enumerate(self._parts))
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self._parts:
+            if isinstance(part, InlineBase64):
+                yield b'"'
+                yield from part.chunks(JSON_STREAM_CHUNK)
+                yield b'"'
+            elif part:
+                yield part
+
+    def materialize(self) -> bytes:
+        return b''.join(self)
+
+
+def _describe_body(body: Any) -> str:
+    """JSON for the debug log, with shared base64 payloads elided."""
+    return json.dumps(body, ensure_ascii=False, default=lambda value: f"<base64 {len(value)} chars>")
+
+
+# 拒绝过压缩请求体（415）的上游，之后直接发送未压缩的请求体
+_UPSTREAM_ENCODING_REJECTED: set = set()
+
+
+def _post_upstream(url: str, *, stream: bool = False, timeout=None, headers: Dict[str, str], body: Any):
+    """POST a JSON body upstream over HTTP/2 when enabled, otherwise over the pooled HTTP/1.1 session.
+
+    With IMAGE_FILE_UPLOADS, images already uploaded to the Files API go by file_id; a request
+    whose references the upstream refuses is sent once more with the images inline.
+    """
+    cfg = current_config()
+    meter = g.get('usage_meter') if has_request_context() else None
+    if meter is not None:
+        meter.upstream_sent = time.perf_counter()
+    refs: List[tuple] = []
+    if cfg.image_file_uploads and isinstance(body, dict):
+        referenced, refs = _attach_image_files(cfg, body, headers)
+    if refs:
+        resp = _post_upstream_body(cfg, url, stream=stream, timeout=timeout,
+                                   headers=_with_beta(headers, FILES_API_BETA), body=referenced)
+        rejected = _rejected_file_refs(resp, refs)
+        if rejected:
+            resp.close()
+            for key, file_id in rejected:
+                # 标记过期：下次出现时重新上传，新文件就绪后删除被拒绝的旧文件
+                entry = _IMAGE_FILES.get(key)
+                if entry is not None and entry['file_id'] == file_id:
+                    _IMAGE_FILES.put(key, dict(entry, expires=0.0))
+            print(f"ℹ️ Upstream rejected image file {', '.join(file_id for _, file_id in rejected)} "
+                  f"({resp.status_code}), resending the images inline")
+            refs = []
+    if not refs:
+        resp = _post_upstream_body(cfg, url, stream=stream, timeout=timeout, headers=headers, body=body)
+    if meter is not None:
+        meter.upstream_headers = time.perf_counter()
+        meter.upstream_status = resp.status_code
+    return resp
+
+
+def _post_upstream_body(cfg: ProxyConfig, url: str, *, stream: bool, timeout, headers: Dict[str, str], body: Any):
+    payload: Any = StreamedJsonBody(body)
+    if not payload.shared:
+        payload = payload.materialize()
+    encoding = cfg.upstream_request_encoding
+    if (encoding in ('gzip', 'zstd') and len(payload) >= cfg.compression_min_bytes
+            and url not in _UPSTREAM_ENCODING_REJECTED and (encoding == 'gzip' or _zstd_available())):
+        raw = payload.materialize() if isinstance(payload, StreamedJsonBody) else payload
+        resp = _send_upstream(cfg, url, stream=stream, timeout=timeout,
+                              headers={**headers, 'content-encoding': encoding},
+                              payload=compress_body(raw, encoding, cfg))
+        if resp.status_code != 415:
+            return resp
+        resp.close()
+        _UPSTREAM_ENCODING_REJECTED.add(url)
+        print(f"ℹ️ Upstream rejected {encoding} request bodies (415), sending them uncompressed from now on")
+    return _send_upstream(cfg, url, stream=stream, timeout=timeout, headers=headers, payload=payload)
+
+
+def _send_upstream(cfg: ProxyConfig, url: str, *, stream: bool, timeout, headers: Dict[str, str], payload: Any):
+    transport = _get_http2_transport(cfg)
+    if transport is not None:
+        if isinstance(payload, StreamedJsonBody):
+            # httpx 对可迭代的请求体默认用 chunked，显式给出长度
+            resp = transport.post(url, stream=stream, timeout=timeout,
+                                  headers={**headers, 'content-length': str(len(payload))}, body=iter(payload))
+        else:
+            resp = transport.post(url, stream=stream, timeout=timeout, headers=headers, body=payload)
+        if resp is not None:
+            return resp
+    return UPSTREAM_SESSION.post(url, stream=stream, timeout=timeout, headers=headers, data=payload, proxies=cfg.proxies)
+
+
+# 上游 Files API：图片首次出现时照常内联发送并在后台上传，之后的请求改用 file_id 引用
+FILES_API_BETA = 'files-api-2025-04-14'
+# 上传失败后这段时间内不再重试同一张图，直接内联
+IMAGE_FILE_RETRY_AFTER = 300.0
+# 后台上传/删除的线程数与排队上限；排满时新图片本次照常内联，下次出现再上传
+IMAGE_UPLOAD_WORKERS = 2
+IMAGE_UPLOAD_MAX_PENDING = 32
+_IMAGE_UPLOADS_PENDING: set = set()
+_IMAGE_UPLOADS_LOCK = threading.Lock()
+_IMAGE_FILE_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS, thread_name_prefix='image-file')
+
+
+def _file_url(files_url: str, file_id: str) -> str:
+    parsed = urlparse(files_url)
+    return urlunparse(parsed._replace(path=parsed.path.rstrip('/') + '/' + file_id))
+
+
+def _delete_image_file(cfg: ProxyConfig, files_url: str, file_id: str, headers: Dict[str, str]) -> None:
+    try:
+        resp = UPSTREAM_SESSION.delete(
+            _file_url(files_url, file_id),
+            headers=headers,
+            timeout=(cfg.upstream_connect_timeout, cfg.nonstream_timeout),
+            proxies=cfg.proxies
+        )
+        resp.close()
+        # 404：上游已经删除（过期或被拒绝的引用），同样算完成
+        if resp.status_code >= 300 and resp.status_code != 404:
+            raise ValueError(f"upstream returned {resp.status_code}")
+        print(f"🗑️ Deleted upstream file {file_id}")
+    except Exception as exc:  # noqa: BLE001 - the file just stays in upstream storage
+        print(f"⚠️ Deleting upstream file {file_id} failed: {exc}")
+
+
+def _forget_image_file(key: tuple, entry: Optional[Dict[str, Any]]) -> None:
+    """Delete the upstream copy of a cache entry that was evicted, expired or replaced."""
+    if entry and entry.get('file_id'):
+        _IMAGE_FILE_EXECUTOR.submit(_delete_image_file, entry['cfg'], key[0], entry['file_id'], entry['headers'])
+
+
+# (files url, 上游 key 指纹, 内容哈希) -> {'file_id', 'expires', 'cfg', 'headers'}；file_id 为 None 表示最近上传失败
+_IMAGE_FILES = _LRUCache(CONFIG.image_file_cache_size, on_evict=_forget_image_file)  # 大小仅在启动时生效
+
+
+def _replace_image_file(key: tuple, entry: Dict[str, Any]) -> None:
+    _forget_image_file(key, _IMAGE_FILES.get(key))
+    _IMAGE_FILES.put(key, entry)
+
+
+def _with_beta(headers: Dict[str, str], beta: str) -> Dict[str, str]:
+    current = [item.strip() for item in headers.get('anthropic-beta', '').split(',') if item.strip()]
+    if beta in current:
+        return headers
+    return {**headers, 'anthropic-beta': ','.join(current + [beta])}
+
+
+def _image_digest(media_type: str, data: Any) -> str:
+    digest = hashlib.sha256(media_type.encode('utf-8') + b'\0')
+    if isinstance(data, InlineBase64):
+        for chunk in data.chunks(JSON_STREAM_CHUNK):
+            digest.update(chunk)
+    else:
+        digest.update(data.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _upload_image_file(cfg: ProxyConfig, key: tuple, media_type: str, data: Any, headers: Dict[str, str]) -> None:
+    """Upload one image to the upstream Files API and cache its file_id (runs on the image-file executor)."""
+    try:
+        encoded = data.source[data.start:] if isinstance(data, InlineBase64) else data
+        raw = base64.b64decode(encoded, validate=True)
+        del encoded
+        filename = f"image-{key[2][:16]}.{media_type.rsplit('/', 1)[-1] or 'bin'}"
+        resp = UPSTREAM_SESSION.post(
+            key[0],
+            headers=headers,
+            files={'file': (filename, raw, media_type)},
+            timeout=(cfg.upstream_connect_timeout, cfg.nonstream_timeout),
+            proxies=cfg.proxies
+        )
+        try:
+            if resp.status_code >= 300:
+                raise ValueError(f"upstream returned {resp.status_code}: {resp.text[:200]}")
+            file_id = resp.json().get('id')
+        finally:
+            resp.close()
+        if not isinstance(file_id, str) or not file_id:
+            raise ValueError('response carries no file id')
+        _replace_image_file(key, {'file_id': file_id, 'expires': time.monotonic() + cfg.image_file_ttl,
+                                  'cfg': cfg, 'headers': headers})
+        print(f"📎 Uploaded image ({len(raw)}B {media_type}) as {file_id}")
+    except Exception as exc:  # noqa: BLE001 - the image keeps going inline
+        _replace_image_file(key, {'file_id': None, 'expires': time.monotonic() + IMAGE_FILE_RETRY_AFTER})
+        print(f"⚠️ Image upload failed, sending it inline: {exc}")
+    finally:
+        with _IMAGE_UPLOADS_LOCK:
+            _IMAGE_UPLOADS_PENDING.discard(key)
+
+
+def _schedule_image_upload(cfg: ProxyConfig, key: tuple, media_type: str, data: Any, headers: Dict[str, str]) -> None:
+    with _IMAGE_UPLOADS_LOCK:
+        if key in _IMAGE_UPLOADS_PENDING or len(_IMAGE_UPLOADS_PENDING) >= IMAGE_UPLOAD_MAX_PENDING:
+            return
+        _IMAGE_UPLOADS_PENDING.add(key)
+    _IMAGE_FILE_EXECUTOR.submit(_upload_image_file, cfg, key, media_type, data, headers)
+
+
+def _attach_image_files(cfg: ProxyConfig, body: Dict[str, Any], headers: Dict[str, str]) -> tuple:
+    """Return (body, refs): images already uploaded are swapped for file references in a copy of body.
+
+    The caller's body is never modified, so it can still be sent inline if the upstream
+    rejects a file_id. Images seen for the first time stay inline and are uploaded in the
+    background; refs lists the (cache key, file_id) pairs the returned body relies on.
+    """
+    refs: List[tuple] = []
+    upload_headers = {k: v for k, v in _with_beta(headers, FILES_API_BETA).items() if k.lower() != 'content-type'}
+    key_id = _api_key_id(cfg.upstream_api_key)
+    now = time.monotonic()
+
+    def _swap(content: Any) -> Any:
+        if isinstance(content, list):
+            swapped = [_swap(item) for item in content]
+            return swapped if any(new is not old for new, old in zip(swapped, content)) else content
+        if not isinstance(content, dict):
+            return content
+        source = content.get('source')
+        if content.get('type') == 'image' and isinstance(source, dict) and source.get('type') == 'base64':
+            data, media_type = source.get('data'), source.get('media_type') or 'application/octet-stream'
+            if isinstance(data, InlineBase64):
+                size = _base64_size(data.source, data.start)
+            elif isinstance(data, str):
+                size = _base64_size(data)
+            else:
+                return content
+            if size < cfg.image_file_min_bytes:
+                return content
+            key = (cfg.upstream_files_url, key_id, _image_digest(media_type, data))
+            entry = _IMAGE_FILES.get(key)
+            if entry is None or entry['expires'] <= now:
+                # 过期的 file_id 在新文件上传成功后删除
+                _schedule_image_upload(cfg, key, media_type, data, upload_headers)
+                return content
+            if entry['file_id'] is None:
+                return content
+            refs.append((key, entry['file_id']))
+            return {**content, 'source': {'type': 'file', 'file_id': entry['file_id']}}
+        nested = content.get('content')
+        swapped = _swap(nested) if isinstance(nested, list) else nested
+        return content if swapped is nested else {**content, 'content': swapped}
+
+    messages = body.get('messages')
+    swapped = _swap(messages) if isinstance(messages, list) else messages
+    return (body, refs) if swapped is messages else ({**body, 'messages': swapped}, refs)
+
+
+def _rejected_file_refs(resp, refs: List[tuple]) -> List[tuple]:
+    """The refs an upstream error names as missing or forbidden; empty for any other response."""
+    if resp.status_code not in (400, 403, 404):
+        return []
+    try:
+        error = json.loads(resp.content).get('error') or {}
+    except (ValueError, AttributeError):
+        return []
+    if not isinstance(error, dict) or error.get('type') not in ('not_found_error', 'permission_error'):
+        return []
+    message = str(error.get('message') or '')
+    return [ref for ref in refs if ref[1] in message]
+
+
+# 透传上游响应时保留的头（其余如 content-length/content-encoding/transfer-encoding 交给 WSGI 层重新生成）
+PASSTHROUGH_RESPONSE_HEADERS = ('content-type', 'request-id', 'retry-after')
+PASSTHROUGH_RESPONSE_HEADER_PREFIXES = ('anthropic-',)
+
+
+def _passthrough_headers(upstream_headers) -> Dict[str, str]:
+    return {
+        k: v for k, v in upstream_headers.items()
+        if k.lower() in PASSTHROUGH_RESPONSE_HEADERS
+        or k.lower().startswith(PASSTHROUGH_RESPONSE_HEADER_PREFIXES)
+    }
+
+
+class UpstreamStallError(Exception):
+    """Upstream stream exceeded its idle timeout or the request deadline."""
+
+
+def _request_deadline() -> Optional[float]:
+    """Absolute (monotonic) deadline for the current request, or None if unbounded."""
+    cfg = current_config()
+    budgets: List[float] = []
+    if cfg.request_max_duration > 0:
+        budgets.append(cfg.request_max_duration)
+    for header in REQUEST_TIMEOUT_HEADERS:
+        raw = request.headers.get(header)
+        if not raw:
+            continue
+        try:
+            client_timeout = float(raw)
+        except ValueError:
+            continue
+        if client_timeout > 0:
+            budgets.append(max(1.0, client_timeout - cfg.request_deadline_margin))
+        break
+    return time.monotonic() + min(budgets) if budgets else None
+
+
+def _upstream_timeout(stream: bool, deadline: Optional[float]):
+    """requests-style (connect, read) timeout honouring the request deadline."""
+    cfg = current_config()
+    if stream:
+        # 看门狗负责空闲/总时长检测；socket 读超时略宽，只用于兜底回收阻塞的读线程
+        return (cfg.upstream_connect_timeout, cfg.stream_idle_timeout + 5 if cfg.stream_idle_timeout > 0 else 300)
+    read_timeout = cfg.nonstream_timeout
+    if deadline is not None:
+        read_timeout = max(0.1, min(read_timeout, deadline - time.monotonic()))
+    return (cfg.upstream_connect_timeout, read_timeout)
+
+
+def _close_upstream(resp, abort: bool = False) -> None:
+    """Close an upstream response.
+
+    When aborting, the socket is shut down first so a reader thread blocked in recv
+    wakes up immediately instead of holding the connection until its read timeout.
+    """
+    if abort and isinstance(resp, requests.Response) and resp.raw is not None:
+        # urllib3 的 HTTPResponse.connection 在流式响应读完之前一直持有连接（HTTP/2 由传输层处理）；
+        # 上游回了 Connection: close 时连接已脱离连接池，只能通过响应自己的 fileno() 找到 socket
+        conn = resp.raw.connection
+        try:
+            if conn is not None and conn.sock is not None:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            else:
+                # shutdown 作用于 socket 本身，复制出的 fd 同样能唤醒阻塞在 recv 上的读线程
+                with socket.socket(fileno=os.dup(resp.raw.fileno())) as sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError) as exc:
+            print(f"⚠️ Upstream socket shutdown skipped ({exc}), reader may wait for its read timeout")
+    try:
+        resp.close()
+    except Exception as exc:  # noqa: BLE001 - connection is being discarded anyway
+        print(f"⚠️ Upstream close error: {exc}")
+
+
+_STREAM_END = object()
+STREAM_DRAIN_GRACE = 0.5  # seconds
+
+
+def _watch_upstream_iter(source: Iterator[bytes], close: Callable[[bool], None], deadline: Optional[float] = None) -> Iterator[Optional[bytes]]:
+    """Pull items from a blocking upstream iterator under an idle/deadline watchdog.
+
+    Items are read on a helper thread so the caller never blocks longer than the
+    keep-alive interval: it receives `None` whenever the client should get a
+    keep-alive frame, and UpstreamStallError once the idle timeout or the deadline
+    is exceeded. `close(aborted)` is always called when iteration ends.
+    """
+    cfg = current_config()
+    if cfg.stream_idle_timeout <= 0 and cfg.stream_keepalive_interval <= 0 and deadline is None:
+        finished = False
+        try:
+            yield from source
+            finished = True
+        finally:
+            close(not finished)
+        return
+
+    items: "queue.Queue[Any]" = queue.Queue(maxsize=64)
+    stop = threading.Event()
+
+    def _put(item: Any) -> bool:
+        # 客户端断开后 stop 被置位，读线程不会永久阻塞在满队列上
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _reader() -> None:
+        try:
+            # 消费方结束后继续读完剩余字节（通常只剩流结束标记），连接才能被连接池复用
+            for item in source:
+                if not stop.is_set():
+                    _put(item)
+            _put(_STREAM_END)
+        except Exception as exc:  # noqa: BLE001 - handed to the consumer
+            _put(exc)
+
+    reader = threading.Thread(target=_reader, name='upstream-reader', daemon=True)
+    reader.start()
+    last_data = time.monotonic()
+    stalled = False
+    try:
+        while True:
+            now = time.monotonic()
+            waits: List[float] = []
+            if cfg.stream_idle_timeout > 0:
+                waits.append(last_data + cfg.stream_idle_timeout - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            if cfg.stream_keepalive_interval > 0:
+                waits.append(cfg.stream_keepalive_interval)
+            try:
+                item = items.get(timeout=max(0.0, min(waits)))
+            except queue.Empty:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    stalled = True
+                    raise UpstreamStallError('request deadline exceeded while waiting for upstream')
+                if cfg.stream_idle_timeout > 0 and now - last_data >= cfg.stream_idle_timeout:
+                    stalled = True
+                    raise UpstreamStallError(f'upstream sent no data for {int(now - last_data)}s')
+                yield None
+                continue
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            last_data = time.monotonic()
+            yield item
+    finally:
+        stop.set()
+        if not stalled:
+            # 正常结束（或客户端断开）时给读线程一点时间读完流尾，避免跨线程中断仍在读取的流
+            reader.join(STREAM_DRAIN_GRACE)
+        if reader.is_alive():
+            # 读线程仍阻塞在上游：异步中断，不让客户端等待 socket 关闭
+            threading.Thread(target=close, args=(True,), name='upstream-close', daemon=True).start()
+        else:
+            close(False)
+
+
+SSE_KEEPALIVE_FRAME = b": keep-alive\n\n"
+
+
+# 用量账本：请求路径上只往内存队列追加记录，后台线程按批写入 SQLite 或 JSONL
+USAGE_FIELDS = (
+    'ts', 'key_id', 'endpoint', 'model', 'stream', 'status', 'input_tokens', 'output_tokens',
+    'cache_creation_input_tokens', 'cache_read_input_tokens', 'latency_ms', 'ttft_ms', 'message_id'
+)
+USAGE_TOKEN_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+USAGE_GROUP_COLUMNS = {
+    'key': 'key_id',
+    'model': 'model',
+    'endpoint': 'endpoint',
+    'status': 'status',
+    'day': "strftime('%Y-%m-%d', ts, 'unixepoch')",
+}
+
+
+def _api_key_id(api_key: str) -> str:
+    # 账本里只保存 key 的指纹，不落盘明文 key
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+
+def _mask_api_key(api_key: str) -> str:
+    return f"{api_key[:5]}…{api_key[-4:]}" if len(api_key) >= 12 else f"{api_key[:2]}…"
+
+
+class BatchedRecordWriter:
+    """Records buffered in memory and appended to a JSONL file in batches by a background thread."""
+
+    name = 'Record writer'
+    thread_name = 'record-writer'
+
+    def __init__(self, path: str, flush_interval: float, batch_size: int, max_pending: int):
+        self.path = path
+        self.flush_interval = max(0.05, flush_interval)
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(1, max_pending)
+        self.dropped = 0
+        self._pending: deque = deque()
+        self._wake = threading.Event()
+        self._flush_waiters: List[threading.Event] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._last_error: Optional[str] = None
+        self._closed = False
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(entry)
+        if self._thread is None:
+            self._start()
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def flush(self, timeout: float = 2.0) -> bool:
+        """Ask the writer thread to persist everything queued so far and wait for it."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        with self._lock:
+            self._flush_waiters.append(done)
+        self._wake.set()
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        self._closed = True
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join(5)
+        if self._pending:
+            self._drain()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                # 延迟到第一条记录再启动线程，gunicorn --preload 时不会在 fork 前留下线程
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._drain()
+        self._drain()
+
+    def _drain(self) -> None:
+        with self._lock:
+            waiters, self._flush_waiters = self._flush_waiters, []
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popleft())
+            try:
+                self._write(batch)
+                self._last_error = None
+            except Exception as exc:  # noqa: BLE001 - keep the batch and retry on the next tick
+                self._pending.extendleft(reversed(batch))
+                if str(exc) != self._last_error:
+                    print(f"⚠️ {self.name} write to {self.path} failed, will retry: {exc}")
+                    self._last_error = str(exc)
+                self._on_write_error()
+                break
+        for waiter in waiters:
+            waiter.set()
+
+    def _on_write_error(self) -> None:
+        pass
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        lines = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in batch)
+        # 整批一次 write：多个 worker 追加同一文件时不会交错
+        with open(self.path, 'a', encoding='utf-8') as fh:
+            fh.write(lines)
+
+
+class UsageLedger(BatchedRecordWriter):
+    """Per-request usage records, persisted in batches (SQLite or JSONL) off the request path."""
+
+    name = 'Usage ledger'
+    thread_name = 'usage-ledger'
+
+    def __init__(self, path: str, fmt: str, flush_interval: float, batch_size: int, max_pending: int):
+        super().__init__(path, flush_interval, batch_size, max_pending)
+        self.format = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'sqlite')
+        self._conn = None
+
+    def _on_write_error(self) -> None:
+        # 下次重试时重新连接
+        self._conn = None
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        if self.format == 'jsonl':
+            super()._write(batch)
+            return
+        if self._conn is None:
+            self._conn = self._connect()
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS usage ({', '.join(USAGE_FIELDS)})"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)")
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO usage ({', '.join(USAGE_FIELDS)}) VALUES ({', '.join('?' * len(USAGE_FIELDS))})",
+                [tuple(entry.get(field) for field in USAGE_FIELDS) for entry in batch]
+            )
+
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        # WAL：多个 worker 写入时互不阻塞读取（管理接口查询）
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def aggregate(self, group_by: List[str], since: Optional[float] = None, until: Optional[float] = None,
+                  key_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        if self.format == 'jsonl':
+            return self._aggregate_jsonl(group_by, since, until, key_id)
+        if not os.path.exists(self.path):
+            return []
+        where, params = [], []
+        for clause, value in (('ts >= ?', since), ('ts < ?', until), ('key_id = ?', key_id)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        columns = [f"{USAGE_GROUP_COLUMNS[name]} AS {name}" for name in group_by]
+        sql = (
+            f"SELECT {', '.join(columns + ['COUNT(*)', 'SUM(status != 200)'])}, "
+            f"{', '.join(f'SUM({field})' for field in USAGE_TOKEN_FIELDS)}, "
+            "SUM(latency_ms), SUM(ttft_ms), COUNT(ttft_ms), MIN(ts), MAX(ts) FROM usage"
+            + (f" WHERE {' AND '.join(where)}" if where else '')
+            + (f" GROUP BY {', '.join(group_by)}" if group_by else '')
+        )
+        import sqlite3
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            return []
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            # 表还没建（尚无记录落盘）
+            return []
+        finally:
+            conn.close()
+        results = []
+        for row in rows:
+            keys = dict(zip(group_by, row[:len(group_by)]))
+            totals = row[len(group_by):]
+            if not totals[0]:
+                continue
+            results.append(_usage_summary(keys, *totals))
+        return results
+
+    def _aggregate_jsonl(self, group_by: List[str], since: Optional[float], until: Optional[float],
+                         key_id: Optional[str]) -> List[Dict[str, Any]]:
+        groups: Dict[tuple, List[Any]] = {}
+        try:
+            fh = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return []
+        with fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                ts = entry.get('ts') or 0
+                if (since is not None and ts < since) or (until is not None and ts >= until) \
+                        or (key_id is not None and entry.get('key_id') != key_id):
+                    continue
+                entry['key'] = entry.get('key_id')
+                entry['day'] = time.strftime('%Y-%m-%d', time.gmtime(ts))
+                group = tuple(entry.get(name) for name in group_by)
+                totals = groups.setdefault(group, [0, 0] + [0] * len(USAGE_TOKEN_FIELDS) + [0.0, 0.0, 0, ts, ts])
+                totals[0] += 1
+                totals[1] += entry.get('status') != 200
+                for offset, field in enumerate(USAGE_TOKEN_FIELDS, start=2):
+                    totals[offset] += entry.get(field) or 0
+                base = 2 + len(USAGE_TOKEN_FIELDS)
+                totals[base] += entry.get('latency_ms') or 0
+                if entry.get('ttft_ms') is not None:
+                    totals[base + 1] += entry['ttft_ms']
+                    totals[base + 2] += 1
+                totals[base + 3] = min(totals[base + 3], ts)
+                totals[base + 4] = max(totals[base + 4], ts)
+        return [_usage_summary(dict(zip(group_by, group)), *totals) for group, totals in groups.items()]
+
+
+def _usage_summary(keys: Dict[str, Any], requests_count: int, errors: int, input_tokens: Optional[int],
+                   output_tokens: Optional[int], cache_creation: Optional[int], cache_read: Optional[int],
+                   latency_total: Optional[float], ttft_total: Optional[float], ttft_count: int,
+                   first_ts: float, last_ts: float) -> Dict[str, Any]:
+    summary = dict(keys)
+    summary.update({
+        'requests': requests_count,
+        'errors': errors or 0,
+        'input_tokens': input_tokens or 0,
+        'output_tokens': output_tokens or 0,
+        'cache_creation_input_tokens': cache_creation or 0,
+        'cache_read_input_tokens': cache_read or 0,
+        'avg_latency_ms': round((latency_total or 0) / requests_count, 1),
+        'avg_ttft_ms': round(ttft_total / ttft_count, 1) if ttft_count else None,
+        'first_seen': first_ts,
+        'last_seen': last_ts,
+    })
+    return summary
+
+
+USAGE_LEDGER: Optional[UsageLedger] = None
+if CONFIG.usage_ledger_path:
+    USAGE_LEDGER = UsageLedger(
+        CONFIG.usage_ledger_path,
+        CONFIG.usage_ledger_format,
+        CONFIG.usage_ledger_flush_interval,
+        CONFIG.usage_ledger_batch_size,
+        CONFIG.usage_ledger_max_pending,
+    )
+    atexit.register(USAGE_LEDGER.close)
+    print(f"📒 Usage ledger: {USAGE_LEDGER.path} ({USAGE_LEDGER.format})")
+
+
+class TrafficCapture(BatchedRecordWriter):
+    """Sanitized requests plus upstream timing traces, one JSON line per request."""
+
+    name = 'Traffic capture'
+    thread_name = 'traffic-capture'
+
+
+CAPTURE_MAX_PENDING = 2000
+# 采集时从请求顶层丢弃的字段（身份信息）；更深层同名的键属于工具定义/参数，原样保留，回放才与原请求一致
+CAPTURE_DROPPED_FIELDS = ('metadata', 'user', 'api_key')
+# 任意层级都替换为 placeholder:redacted 的凭据字段（只替换字符串值，不改变结构）
+CAPTURE_REDACTED_FIELDS = ('api_key',)
+# 图片替换为等大小的占位符，回放时再生成同样大小的数据
+CAPTURE_PLACEHOLDER_PREFIX = 'placeholder:'
+# 值可能是远程图片 URL 的字段，替换为 placeholder:remote
+CAPTURE_URL_FIELDS = ('url', 'image_url', 'image')
+
+TRAFFIC_CAPTURE: Optional[TrafficCapture] = None
+if CONFIG.capture_path:
+    TRAFFIC_CAPTURE = TrafficCapture(CONFIG.capture_path, 1.0, 64, CAPTURE_MAX_PENDING)
+    atexit.register(TRAFFIC_CAPTURE.close)
+    print(f"🎙️ Traffic capture: {TRAFFIC_CAPTURE.path} (sample rate {CONFIG.capture_sample_rate})")
+
+
+def _base64_size(encoded: str, start: int = 0) -> int:
+    return (len(encoded) - start) * 3 // 4 - encoded[max(start, len(encoded) - 2):].count('=')
+
+
+def _sanitize_for_capture(value: Any, top: bool = True) -> Any:
+    """Copy a request body for capture: top-level identity fields dropped, credentials, images and URLs replaced by placeholders."""
+    if isinstance(value, dict):
+        sanitized: Dict[str, Any] = {}
+        for key, item in value.items():
+            if top and key in CAPTURE_DROPPED_FIELDS:
+                continue
+            if key in CAPTURE_REDACTED_FIELDS and isinstance(item, str):
+                sanitized[key] = f"{CAPTURE_PLACEHOLDER_PREFIX}redacted"
+            elif key == 'data' and value.get('type') == 'base64' and isinstance(item, str):
+                sanitized[key] = f"{CAPTURE_PLACEHOLDER_PREFIX}bytes={_base64_size(item)}"
+            elif key == 'data' and isinstance(item, InlineBase64):
+                sanitized[key] = f"{CAPTURE_PLACEHOLDER_PREFIX}bytes={_base64_size(item.source, item.start)}"
+            elif key in CAPTURE_URL_FIELDS and isinstance(item, str) and item.startswith(('http://', 'https://')):
+                # 远程 URL 可能带签名，不落盘（image_url / image 也接受直接写成字符串的 URL）
+                sanitized[key] = f"{CAPTURE_PLACEHOLDER_PREFIX}remote"
+            else:
+                sanitized[key] = _sanitize_for_capture(item, False)
+        return sanitized
+    if isinstance(value, list):
+        return [_sanitize_for_capture(item, False) for item in value]
+    if isinstance(value, str) and value.startswith('data:') and ';base64,' in value[:256]:
+        # 只看头部和长度，不把 base64 部分切出来
+        comma = value.index(',')
+        return f"{CAPTURE_PLACEHOLDER_PREFIX}{value[5:comma].split(';')[0]};bytes={_base64_size(value, comma + 1)}"
+    return value
+
+
+class UsageMeter:
+    """Usage of one proxied request; recorded into the ledger (and capture) exactly once via finish()."""
+
+    def __init__(self, endpoint: str, model: str, stream: bool):
+        # 流式响应在请求上下文结束后才迭代完，所以这里先取好 key 和起始时间
+        in_request = has_request_context()
+        self.api_key = (g.get('api_key') if in_request else None) or ''
+        self.started = (g.get('request_started') if in_request else None) or time.perf_counter()
+        self.ts = time.time() - (time.perf_counter() - self.started)
+        self.endpoint = endpoint
+        self.model = model
+        self.stream = stream
+        self.usage: Dict[str, Any] = {}
+        self.message_id: Optional[str] = None
+        self.first_token_at: Optional[float] = None
+        self.finished = False
+        self.upstream_status: Optional[int] = None
+        self.upstream_sent: Optional[float] = None
+        self.upstream_headers: Optional[float] = None
+        self.capture: Optional[Dict[str, Any]] = None
+        if in_request:
+            # _post_upstream 通过 g 找到当前请求的 meter，记录上游时间点
+            g.usage_meter = self
+            if TRAFFIC_CAPTURE is not None and self.api_key \
+                    and random.random() < current_config().capture_sample_rate:
+                self.capture = {'request': None, 'events': [], 'content': None}
+
+    @property
+    def active(self) -> bool:
+        """Whether anything consumes this meter (passthrough skips SSE inspection otherwise)."""
+        return bool(self.api_key) and (USAGE_LEDGER is not None or self.capture is not None)
+
+    def capture_request(self, body: Any) -> None:
+        if self.capture is not None:
+            self.capture['request'] = _sanitize_for_capture(body)
+
+    def capture_content(self, content: Any) -> None:
+        """Record [block type, size] of a non-streamed response (sizes only, no text)."""
+        if self.capture is None or not isinstance(content, list):
+            return
+        blocks = []
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            if block.get('type') == 'tool_use':
+                size = len(json.dumps(block.get('input') or {}, ensure_ascii=False))
+            else:
+                size = len(block.get('text') or block.get('thinking') or '')
+            blocks.append([block.get('type'), size])
+        self.capture['content'] = blocks
+
+    def trace_event(self, event: Dict[str, Any]) -> None:
+        """Append [ms since the upstream request was sent, event type, payload size] to the capture."""
+        if self.capture is None:
+            return
+        event_type = event.get('type') or ''
+        size = 0
+        if event_type == 'content_block_start':
+            event_type = f"{event_type}:{(event.get('content_block') or {}).get('type', 'text')}"
+        elif event_type == 'content_block_delta':
+            delta = event.get('delta') or {}
+            size = len(delta.get('text') or delta.get('partial_json') or delta.get('thinking') or '')
+        since = self.upstream_sent or self.started
+        self.capture['events'].append([round((time.perf_counter() - since) * 1000, 1), event_type, size])
+
+    def observe(self, usage: Optional[Dict[str, Any]]) -> None:
+        if usage:
+            # message_delta 的 output_tokens 是累计值，直接覆盖
+            self.usage.update({k: v for k, v in usage.items() if v is not None})
+
+    def mark_first_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self, status: int) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if not self.active:
+            return
+        entry = {
+            'ts': round(self.ts, 3),
+            'key_id': _api_key_id(self.api_key),
+            'endpoint': self.endpoint,
+            'model': self.model,
+            'stream': self.stream,
+            'status': status,
+            'latency_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'ttft_ms': round((self.first_token_at - self.started) * 1000, 1) if self.first_token_at else None,
+            'message_id': self.message_id,
+        }
+        for field in USAGE_TOKEN_FIELDS:
+            entry[field] = self.usage.get(field) or 0
+        if USAGE_LEDGER is not None:
+            USAGE_LEDGER.record(entry)
+        if self.capture is not None and self.capture['request'] is not None:
+            sent = self.upstream_sent or self.started
+            entry.update({
+                'request': self.capture['request'],
+                'upstream': {
+                    'status': self.upstream_status,
+                    'headers_ms': round((self.upstream_headers - sent) * 1000, 1) if self.upstream_headers else None,
+                    'usage': self.usage,
+                    'events': self.capture['events'],
+                    'content': self.capture['content'],
+                }
+            })
+            TRAFFIC_CAPTURE.record(entry)
+
+
+# 客户端中途断开时记录的状态码（沿用 nginx 的 499）
+STATUS_CLIENT_CLOSED = 499
+
+
+def _scan_sse_usage(buffer: bytes, meter: UsageMeter) -> bytes:
+    """Feed complete SSE lines to the meter; returns the trailing partial line."""
+    capturing = meter.capture is not None
+    *lines, rest = buffer.split(b"\n")
+    for line in lines:
+        if not line.startswith(b'data:'):
+            continue
+        if meter.first_token_at is None and b'"content_block_delta"' in line:
+            meter.mark_first_token()
+        # 只解码带 usage 的事件（message_start / message_delta），其余字节原样透传；采集时例外
+        if not capturing and b'"usage"' not in line:
+            continue
+        try:
+            event = json.loads(line[5:])
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+        if capturing:
+            meter.trace_event(event)
+        if event.get('type') == 'message_start':
+            message = event.get('message') or {}
+            meter.message_id = message.get('id')
+            meter.observe(message.get('usage'))
+        elif event.get('type') == 'message_delta':
+            meter.observe(event.get('usage'))
+    return rest
+
+
+def _relay_upstream_stream(resp, deadline: Optional[float] = None, meter: Optional[UsageMeter] = None) -> Iterator[bytes]:
+    """Relay upstream SSE bytes as-is; lines are only inspected for usage when a meter is given."""
+    at_event_boundary = True
+    status = resp.status_code
+    pending = b""
+    completed = False
+    try:
+        # chunk_size=None 时按上游实际到达的块产出，不会为凑满缓冲区而等待
+        for chunk in _watch_upstream_iter(resp.iter_content(chunk_size=None), lambda aborted: _close_upstream(resp, aborted), deadline):
+            if chunk is None:
+                # 只在完整事件之间插入注释帧，避免截断上游事件
+                if at_event_boundary:
+                    yield SSE_KEEPALIVE_FRAME
+                continue
+            if chunk:
+                at_event_boundary = chunk.endswith(b"\n\n")
+                if meter is not None:
+                    pending = _scan_sse_usage(pending + chunk, meter)
+                yield chunk
+        completed = True
+    except UpstreamStallError as exc:
+        print(f"⏱️ Passthrough stream stalled: {exc}")
+        status = 504
+        error = {'type': 'error', 'error': {'type': 'timeout_error', 'message': str(exc)}}
+        prefix = b"" if at_event_boundary else b"\n\n"
+        yield prefix + f"event: error\ndata: {json.dumps(error, ensure_ascii=False)}\n\n".encode('utf-8')
+        completed = True
+    except Exception as exc:
+        print(f"❌ Passthrough stream error: {exc}")
+        status = 502
+        completed = True
+    finally:
+        if meter is not None:
+            if pending:
+                _scan_sse_usage(pending + b"\n", meter)
+            meter.finish(status if completed else STATUS_CLIENT_CLOSED)
+
+
 # User ID 管理
 CURRENT_USER_ID = None
 LAST_UPDATE_TIME = 0
@@ -563,20 +2418,77 @@ def get_current_user_id():
     
     return CURRENT_USER_ID
 
-# API Key 验证
+# API Key 验证（OpenAI 客户端用 Authorization: Bearer，Anthropic 客户端用 x-api-key）
 def require_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        cfg = current_config()
         auth = request.headers.get('Authorization', '')
-        api_key = auth.replace('Bearer ', '').strip()
+        api_key = auth.replace('Bearer ', '').strip() or request.headers.get('x-api-key', '').strip()
 
-        if api_key not in ALLOWED_API_KEYS:
+        if api_key not in cfg.allowed_api_keys:
             return jsonify({'error': 'Invalid API key'}), 401
 
+        g.api_key = api_key
+        g.request_started = time.perf_counter()
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def require_admin_key(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        cfg = current_config()
+        if not cfg.admin_api_keys:
+            return jsonify({'error': 'Admin API disabled (set ADMIN_API_KEYS)'}), 404
+        auth = request.headers.get('Authorization', '')
+        api_key = auth.replace('Bearer ', '').strip() or request.headers.get('x-api-key', '').strip()
+
+        if api_key not in cfg.admin_api_keys:
+            return jsonify({'error': 'Invalid admin API key'}), 401
+
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def decode_request_body(f):
+    """Decompress gzip/deflate/zstd request bodies so request.get_json() sees plain JSON.
+
+    The compressed body is read straight from the WSGI input before Flask touches it, and
+    the decompressed bytes are installed as a fresh wsgi.input / CONTENT_LENGTH, from which
+    request.stream is then built as usual.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        encoding = request.headers.get('Content-Encoding', '').strip()
+        if encoding and request.method == 'POST':
+            cfg = current_config()
+            raw = get_input_stream(request.environ, max_content_length=request.max_content_length).read()
+            try:
+                data = decompress_body(raw, encoding, cfg.max_decompressed_body_bytes)
+            except RequestBodyTooLarge as exc:
+                return jsonify({'error': str(exc)}), 413
+            except UnsupportedContentEncoding as exc:
+                return jsonify({'error': str(exc)}), 415
+            except ValueError as exc:
+                return jsonify({'error': str(exc)}), 400
+            del raw
+            request.environ['wsgi.input'] = io.BytesIO(data)
+            request.environ['CONTENT_LENGTH'] = str(len(data))
+
         return f(*args, **kwargs)
 
     return decorated
 
+def _request_json(silent: bool = False) -> Any:
+    """request.get_json(); with LEAN_REQUEST_BODIES the raw body is not kept alive next to the parsed one."""
+    if not current_config().lean_request_bodies:
+        return request.get_json(silent=silent)
+    return request.get_json(silent=silent, cache=False)
+
+
 def convert_messages_to_anthropic(messages):
     anthropic_messages = []
     system_text_fragments: List[str] = []
@@ -647,14 +2559,21 @@ def convert_anthropic_content_to_openai(content_blocks: List[Dict[str, Any]]):
 
     return ''.join(text_fragments), tool_calls
 
-def stream_anthropic_to_openai(response) -> Iterator[bytes]:
+def stream_anthropic_to_openai(response, on_usage: Optional[Callable[[Dict[str, Any]], None]] = None, deadline: Optional[float] = None,
+                               meter: Optional[UsageMeter] = None, include_usage: bool = False) -> Iterator[bytes]:
     message_id = f"chatcmpl-{int(time.time())}"
     sent_role = False
     tool_call_index = 0
     pending_stop_reason: Optional[str] = None
+    meter = meter or UsageMeter('chat.completions', current_config().default_model, True)
+    status = STATUS_CLIENT_CLOSED
 
     try:
-        for line in response.iter_lines(decode_unicode=False):
+        for line in _watch_upstream_iter(response.iter_lines(decode_unicode=False), lambda aborted: _close_upstream(response, aborted), deadline):
+            if line is None:
+                yield SSE_KEEPALIVE_FRAME
+                continue
+
             if not line:
                 continue
 
@@ -664,7 +2583,10 @@ def stream_anthropic_to_openai(response) -> Iterator[bytes]:
             data = line[5:].strip()
 
             if data == b'[DONE]':
+                if include_usage:
+                    yield _build_usage_chunk(message_id, meter.usage)
                 yield b"data: [DONE]\n\n"
+                status = 200
                 break
 
             try:
@@ -674,6 +2596,16 @@ def stream_anthropic_to_openai(response) -> Iterator[bytes]:
                 continue
 
             event_type = event.get('type')
+            if meter.capture is not None:
+                meter.trace_event(event)
+
+            if event_type == 'message_start':
+                start_usage = event.get('message', {}).get('usage') or {}
+                meter.message_id = event.get('message', {}).get('id')
+                meter.observe(start_usage)
+                if on_usage:
+                    on_usage(start_usage)
+                continue
 
             if event_type == 'content_block_start':
                 block = event.get('content_block', {}) or {}
@@ -693,12 +2625,14 @@ def stream_anthropic_to_openai(response) -> Iterator[bytes]:
                         delta['role'] = 'assistant'
                         sent_role = True
                     tool_call_index += 1
+                    meter.mark_first_token()
                     yield _build_stream_chunk(message_id, delta)
                 continue
 
             if event_type == 'content_block_delta':
                 delta_text = event.get('delta', {}).get('text', '')
                 if delta_text:
+                    meter.mark_first_token()
                     delta_payload: Dict[str, Any] = {'content': delta_text}
                     if not sent_role:
                         delta_payload['role'] = 'assistant'
@@ -708,44 +2642,218 @@ def stream_anthropic_to_openai(response) -> Iterator[bytes]:
 
             if event_type == 'message_delta':
                 pending_stop_reason = event.get('delta', {}).get('stop_reason') or pending_stop_reason
+                meter.observe(event.get('usage'))
                 continue
 
             if event_type == 'message_stop':
                 stop_reason = event.get('stop_reason') or event.get('message', {}).get('stop_reason') or pending_stop_reason
                 yield _build_stream_chunk(message_id, {}, _map_stop_reason(stop_reason))
+                if include_usage:
+                    yield _build_usage_chunk(message_id, meter.usage)
                 yield b"data: [DONE]\n\n"
+                status = 200
                 break
-
+        else:
+            status = 200
+
+    except UpstreamStallError as exc:
+        print(f"⏱️ Stream stalled: {exc}")
+        status = 504
+        yield _build_stream_error(str(exc))
+        if include_usage:
+            yield _build_usage_chunk(message_id, meter.usage)
+        yield b"data: [DONE]\n\n"
     except Exception as exc:
         print(f"❌ Stream error: {exc}")
+        status = 502
         yield _build_stream_chunk(message_id, {}, 'stop')
+        if include_usage:
+            yield _build_usage_chunk(message_id, meter.usage)
         yield b"data: [DONE]\n\n"
+    finally:
+        meter.finish(status)
+
+class UpstreamStreamError(Exception):
+    """Upstream emitted an `error` event in the middle of a stream."""
+
+    def __init__(self, error: Dict[str, Any]):
+        super().__init__(error.get('message') or 'upstream stream error')
+        self.error = error
+
+
+def aggregate_anthropic_stream(lines: Iterator[Optional[bytes]], message: Dict[str, Any],
+                               on_event: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """Fold Anthropic SSE lines into `message`, shaped like a non-streaming response.
+
+    `message` is filled in place so callers still hold the partial content and usage
+    when the stream stalls or the upstream reports an error half-way.
+    """
+    message.setdefault('content', [])
+    usage = message.setdefault('usage', {})
+    blocks: Dict[int, Dict[str, Any]] = {}
+    fragments: Dict[int, List[str]] = {}
+    signatures: Dict[int, List[str]] = {}
+
+    for line in lines:
+        if not line or not line.startswith(b'data:'):
+            continue
+        data = line[5:].strip()
+        if data == b'[DONE]':
+            break
+        try:
+            event = json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as err:
+            print(f"⚠️ Stream decode error: {err}, line: {line[:100]}")
+            continue
+
+        if on_event:
+            on_event(event)
+        event_type = event.get('type')
+        if event_type == 'message_start':
+            start = event.get('message') or {}
+            message.update({k: v for k, v in start.items() if k not in ('content', 'usage')})
+            usage.update(start.get('usage') or {})
+        elif event_type == 'content_block_start':
+            index = event.get('index', len(blocks))
+            blocks[index] = dict(event.get('content_block') or {})
+            fragments[index] = []
+            message['content'].append(blocks[index])
+        elif event_type == 'content_block_delta':
+            index = event.get('index', 0)
+            if index not in blocks:
+                blocks[index] = {'type': 'text', 'text': ''}
+                fragments[index] = []
+                message['content'].append(blocks[index])
+            delta = event.get('delta') or {}
+            # 片段先收集再拼接，避免长输出下字符串反复拷贝
+            for key in ('text', 'partial_json', 'thinking'):
+                if key in delta:
+                    fragments[index].append(delta[key])
+                    break
+            else:
+                # signature_delta 校验 thinking 块，丢失会导致多轮对话回传时被上游拒绝
+                if 'signature' in delta:
+                    signatures.setdefault(index, []).append(delta['signature'])
+        elif event_type == 'content_block_stop':
+            index = event.get('index', 0)
+            _finalize_stream_block(blocks.get(index), fragments.pop(index, None), signatures.pop(index, None))
+        elif event_type == 'message_delta':
+            delta = event.get('delta') or {}
+            for key in ('stop_reason', 'stop_sequence'):
+                if delta.get(key) is not None:
+                    message[key] = delta[key]
+            usage.update(event.get('usage') or {})
+        elif event_type == 'message_stop':
+            break
+        elif event_type == 'error':
+            raise UpstreamStreamError(event.get('error') or {})
+
+    for index in set(fragments) | set(signatures):
+        _finalize_stream_block(blocks.get(index), fragments.get(index), signatures.get(index))
+    return message
+
+
+def _finalize_stream_block(block: Optional[Dict[str, Any]], pending: Optional[List[str]],
+                           signature: Optional[List[str]] = None) -> None:
+    if block is None:
+        return
+    if signature:
+        block['signature'] = block.get('signature', '') + ''.join(signature)
+    if not pending:
+        return
+    joined = ''.join(pending)
+    block_type = block.get('type')
+    if block_type == 'tool_use':
+        block['input'] = _parse_tool_call_arguments(joined)
+    elif block_type == 'thinking':
+        block['thinking'] = block.get('thinking', '') + joined
+    else:
+        block['text'] = block.get('text', '') + joined
+
+
+def _openai_usage(usage: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    prompt_tokens = (usage or {}).get('input_tokens', 0) or 0
+    completion_tokens = (usage or {}).get('output_tokens', 0) or 0
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens
+    }
+
+
+def _build_openai_completion(result: Dict[str, Any], model: str) -> Dict[str, Any]:
+    message_text, tool_calls = convert_anthropic_content_to_openai(result.get('content', []))
+    finish_reason = _map_stop_reason(result.get('stop_reason'))
+
+    message_payload: Dict[str, Any] = {'role': 'assistant', 'content': message_text}
+    if tool_calls:
+        message_payload['tool_calls'] = tool_calls
+
+    return {
+        'id': result.get('id', f"chatcmpl-{int(time.time())}"),
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': message_payload,
+            'finish_reason': finish_reason
+        }],
+        'usage': _openai_usage(result.get('usage'))
+    }
+
+@app.after_request
+def compress_response(response):
+    """Compress buffered (non-streaming) JSON responses per the client's Accept-Encoding."""
+    cfg = current_config()
+    if (not cfg.response_compression or response.direct_passthrough or response.is_streamed
+            or response.status_code in (204, 304) or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < cfg.compression_min_bytes:
+        return response
+    encoding = _negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+    response.set_data(compress_body(data, encoding, cfg))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 
 @app.route('/v1/chat/completions', methods=['POST', 'OPTIONS'])
 @require_api_key
+@decode_request_body
 def chat_completions():
+    cfg = current_config()
     if request.method == 'OPTIONS':
         return '', 204
 
+    meter: Optional[UsageMeter] = None
     try:
-        data = request.get_json() or {}
+        data = _request_json() or {}
         messages = data.get('messages', [])
-        model = _normalize_model_name(data.get('model', DEFAULT_MODEL))
+        model = _normalize_model_name(data.get('model', cfg.default_model))
         query_max_tokens = _coerce_positive_int(request.args.get('max_tokens'))
         body_max_tokens = _coerce_positive_int(data.get('max_tokens'))
         requested_max_tokens = query_max_tokens or body_max_tokens
         stream = data.get('stream', False)
+        stream_options = data.get('stream_options') if isinstance(data.get('stream_options'), dict) else {}
+        meter = UsageMeter('chat.completions', model, bool(stream))
+        meter.capture_request(data)
 
         try:
             anthropic_messages, system_content = convert_messages_to_anthropic(messages)
         except ValueError as err:
+            meter.finish(400)
             return jsonify({'error': str(err)}), 400
 
         body = {
             'model': model,
             'messages': anthropic_messages,
             'metadata': {'user_id': get_current_user_id()},  # 使用动态生成的 user_id
-            'stream': stream
+            'stream': stream or cfg.upstream_always_stream
         }
 
         converted_tools = _convert_tools(data.get('tools'))
@@ -757,33 +2865,32 @@ def chat_completions():
             body['tool_choice'] = converted_tool_choice
 
         # fizzlycode 的兼容层要求固定的 system 前缀，否则直接 400
-        system_blocks = [{'type': 'text', 'text': DEFAULT_SYSTEM_PROMPT}]
+        system_blocks = [{'type': 'text', 'text': cfg.default_system_prompt}]
         if system_content:
             system_blocks.append({'type': 'text', 'text': system_content})
         body['system'] = system_blocks
 
         # Compute final max_tokens (dynamic if enabled)
-        max_tokens = _apply_dynamic_max_tokens(model, requested_max_tokens, anthropic_messages, system_blocks)
+        max_tokens = _apply_dynamic_max_tokens(model, requested_max_tokens, anthropic_messages, system_blocks, converted_tools)
         body['max_tokens'] = max_tokens
 
-        headers = dict(UPSTREAM_HEADERS_BASE)
-        headers['authorization'] = f'Bearer {UPSTREAM_API_KEY}'
+        headers = _build_upstream_headers()
 
-        print(f"📤 Request body: {json.dumps(body, ensure_ascii=False)}")
+        print(f"📤 Request body: {_describe_body(body)}")
 
         common_kwargs = {
             'headers': headers,
-            'json': body
+            'body': body
         }
-        if PROXIES:
-            common_kwargs['proxies'] = PROXIES
+
+        deadline = _request_deadline()
 
         if stream:
-            # 流式请求，增加超时时间，禁用缓冲
-            resp = requests.post(
-                API_URL,
+            # 流式请求：空闲/总时长由看门狗控制，禁用缓冲
+            resp = _post_upstream(
+                cfg.api_url,
                 stream=True,
-                timeout=(10, 300),  # (连接超时, 读取超时)
+                timeout=_upstream_timeout(True, deadline),  # (连接超时, 读取超时)
                 **common_kwargs
             )
 
@@ -794,11 +2901,18 @@ def chat_completions():
                 except Exception:
                     err_json = {'error': resp.text}
                 print(f"❌ API Error ({resp.status_code}): {err_json}")
+                meter.finish(resp.status_code)
                 return jsonify({'upstream_status': resp.status_code, 'upstream_error': err_json}), resp.status_code
 
-            # 创建流式响应
+            def _on_usage(usage: Dict[str, Any]) -> None:
+                _observe_input_tokens(model, anthropic_messages, system_blocks, converted_tools, usage)
+
+            # 创建流式响应；stream_with_context 让生成器在视图返回后仍使用本请求固定的配置快照
             response = Response(
-                stream_anthropic_to_openai(resp),
+                stream_with_context(stream_anthropic_to_openai(
+                    resp, on_usage=_on_usage, deadline=deadline,
+                    meter=meter, include_usage=bool(stream_options.get('include_usage'))
+                )),
                 content_type='text/event-stream; charset=utf-8',
                 direct_passthrough=True  # 禁用 Flask 缓冲
             )
@@ -807,10 +2921,12 @@ def chat_completions():
             response.headers['Connection'] = 'keep-alive'
             return response
 
-        else:
-            resp = requests.post(
-                API_URL,
-                timeout=120,
+        elif cfg.upstream_always_stream:
+            # 以流式调用上游并增量聚合：不受固定读超时限制，停滞可被看门狗及早发现
+            resp = _post_upstream(
+                cfg.api_url,
+                stream=True,
+                timeout=_upstream_timeout(True, deadline),
                 **common_kwargs
             )
             if resp.status_code != 200:
@@ -818,72 +2934,281 @@ def chat_completions():
                     err_json = resp.json()
                 except Exception:
                     err_json = {'error': resp.text}
+                resp.close()
                 print(f"❌ API Error ({resp.status_code}): {err_json}")
+                meter.finish(resp.status_code)
                 return jsonify({'upstream_status': resp.status_code, 'upstream_error': err_json}), resp.status_code
 
-            result = json.loads(resp.content.decode('utf-8'))
-            message_text, tool_calls = convert_anthropic_content_to_openai(result.get('content', []))
-            finish_reason = _map_stop_reason(result.get('stop_reason'))
-
-            message_payload: Dict[str, Any] = {'role': 'assistant', 'content': message_text}
-            if tool_calls:
-                message_payload['tool_calls'] = tool_calls
-
-            return jsonify({
-                'id': result.get('id', f"chatcmpl-{int(time.time())}"),
-                'object': 'chat.completion',
-                'created': int(time.time()),
-                'model': model,
-                'choices': [{
-                    'index': 0,
-                    'message': message_payload,
-                    'finish_reason': finish_reason
-                }],
-                'usage': {
-                    'prompt_tokens': result.get('usage', {}).get('input_tokens', 0),
-                    'completion_tokens': result.get('usage', {}).get('output_tokens', 0),
-                    'total_tokens': result.get('usage', {}).get('input_tokens', 0) + result.get('usage', {}).get(
-                        'output_tokens', 0)
-                }
-            })
+            result: Dict[str, Any] = {}
+            lines = _watch_upstream_iter(
+                resp.iter_lines(decode_unicode=False),
+                lambda aborted: _close_upstream(resp, aborted),
+                deadline
+            )
+            try:
+                aggregate_anthropic_stream(lines, result, meter.trace_event if meter.capture is not None else None)
+            except UpstreamStallError as err:
+                print(f"⏱️ Aggregated stream stalled: {err}")
+                meter.observe(result.get('usage'))
+                meter.finish(504)
+                return jsonify({
+                    'error': {'message': str(err), 'type': 'timeout_error', 'param': None, 'code': 'upstream_stalled'},
+                    'usage': _openai_usage(result.get('usage'))
+                }), 504
+            except UpstreamStreamError as err:
+                print(f"❌ Upstream stream error: {err.error}")
+                meter.observe(result.get('usage'))
+                meter.finish(502)
+                return jsonify({
+                    'upstream_status': 502,
+                    'upstream_error': {'type': 'error', 'error': err.error},
+                    'usage': _openai_usage(result.get('usage'))
+                }), 502
+            finally:
+                lines.close()
+
+            _observe_input_tokens(model, anthropic_messages, system_blocks, converted_tools, result.get('usage'))
+            meter.message_id = result.get('id')
+            meter.observe(result.get('usage'))
+            meter.capture_content(result.get('content'))
+            meter.finish(200)
+            return jsonify(_build_openai_completion(result, model))
+
+        else:
+            resp = _post_upstream(
+                cfg.api_url,
+                timeout=_upstream_timeout(False, deadline),
+                **common_kwargs
+            )
+            if resp.status_code != 200:
+                try:
+                    err_json = resp.json()
+                except Exception:
+                    err_json = {'error': resp.text}
+                print(f"❌ API Error ({resp.status_code}): {err_json}")
+                meter.finish(resp.status_code)
+                return jsonify({'upstream_status': resp.status_code, 'upstream_error': err_json}), resp.status_code
 
+            # json.loads 直接解析 bytes，省去一次完整的 decode 拷贝
+            result = json.loads(resp.content)
+            _observe_input_tokens(model, anthropic_messages, system_blocks, converted_tools, result.get('usage'))
+            meter.message_id = result.get('id')
+            meter.observe(result.get('usage'))
+            meter.capture_content(result.get('content'))
+            meter.finish(200)
+            return jsonify(_build_openai_completion(result, model))
+
+    except UpstreamSendError as err:
+        print(f"❌ Upstream send error: {err}")
+        if meter is not None:
+            meter.finish(502)
+        return jsonify({
+            'upstream_status': 502,
+            'upstream_error': {'type': 'error', 'error': {'type': 'api_error', 'message': str(err)}}
+        }), 502
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         import traceback
         traceback.print_exc()
+        if meter is not None:
+            meter.finish(500)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/v1/messages', methods=['POST', 'OPTIONS'])
+@require_api_key
+@decode_request_body
+def messages_passthrough():
+    """Anthropic Messages API passthrough.
+
+    Only the proxy's cross-cutting concerns are applied to the request (model aliases,
+    metadata.user_id, max_tokens clamping); the upstream response is relayed byte-for-byte.
+    """
+    cfg = current_config()
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    meter: Optional[UsageMeter] = None
+    try:
+        data = _request_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'type': 'error', 'error': {'type': 'invalid_request_error', 'message': '请求体必须是 JSON 对象'}}), 400
+
+        model = _normalize_model_name(data.get('model', cfg.default_model))
+        stream = bool(data.get('stream', False))
+        meter = UsageMeter('messages', model, stream)
+        meter.capture_request(data)
+        data['model'] = model
+        metadata = data.get('metadata') if isinstance(data.get('metadata'), dict) else {}
+        metadata['user_id'] = get_current_user_id()
+        data['metadata'] = metadata
+        data['max_tokens'] = _apply_dynamic_max_tokens(
+            model,
+            _coerce_positive_int(data.get('max_tokens')),
+            data.get('messages') or [],
+            data.get('system') or [],
+            data.get('tools')
+        )
+
+        _share_inline_payloads(data.get('messages'))
+
+        common_kwargs = {
+            'headers': _build_upstream_headers(),
+            'body': data
+        }
+
+        deadline = _request_deadline()
+
+        if stream:
+            resp = _post_upstream(cfg.api_url, stream=True, timeout=_upstream_timeout(True, deadline), **common_kwargs)
+            if resp.status_code != 200:
+                print(f"❌ API Error ({resp.status_code}): {resp.text[:500]}")
+            response = Response(
+                stream_with_context(_relay_upstream_stream(resp, deadline, meter if meter.active else None)),
+                status=resp.status_code,
+                headers=_passthrough_headers(resp.headers),
+                direct_passthrough=True
+            )
+            response.headers['Cache-Control'] = 'no-cache, no-transform'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
+        resp = _post_upstream(cfg.api_url, timeout=_upstream_timeout(False, deadline), **common_kwargs)
+        if resp.status_code != 200:
+            print(f"❌ API Error ({resp.status_code}): {resp.text[:500]}")
+        elif meter.active:
+            try:
+                result = json.loads(resp.content)
+                meter.message_id = result.get('id')
+                meter.observe(result.get('usage'))
+                meter.capture_content(result.get('content'))
+            except (ValueError, AttributeError):
+                pass
+        meter.finish(resp.status_code)
+        return Response(resp.content, status=resp.status_code, headers=_passthrough_headers(resp.headers))
+
+    except UpstreamSendError as err:
+        print(f"❌ Upstream send error: {err}")
+        if meter is not None:
+            meter.finish(502)
+        return jsonify({'type': 'error', 'error': {'type': 'api_error', 'message': str(err)}}), 502
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        if meter is not None:
+            meter.finish(500)
+        return jsonify({'type': 'error', 'error': {'type': 'api_error', 'message': str(e)}}), 500
+
+@app.route('/v1/messages/count_tokens', methods=['POST', 'OPTIONS'])
+@require_api_key
+@decode_request_body
+def count_tokens():
+    """Anthropic-style token counting, answered locally by the proxy's estimator."""
+    cfg = current_config()
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    data = _request_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'type': 'error', 'error': {'type': 'invalid_request_error', 'message': '请求体必须是 JSON 对象'}}), 400
+
+    model = _normalize_model_name(data.get('model', cfg.default_model))
+    tokens = _estimate_input_tokens(data.get('messages') or [], data.get('system') or [], data.get('tools'), model)
+    return jsonify({'input_tokens': tokens})
+
 @app.route('/v1/models', methods=['GET', 'OPTIONS'])
 @require_api_key
 def list_models():
+    cfg = current_config()
     if request.method == 'OPTIONS':
         return '', 204
 
     return jsonify({
         'object': 'list',
-        'data': [{'id': DEFAULT_MODEL, 'object': 'model', 'created': 0, 'owned_by': 'anthropic'}]
+        'data': [{'id': cfg.default_model, 'object': 'model', 'created': 0, 'owned_by': 'anthropic'}]
+    })
+
+def _parse_time_param(value: Optional[str]) -> Optional[float]:
+    """Epoch seconds or an ISO-8601 date/datetime (UTC when no offset is given)."""
+    if value is None or not value.strip():
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+@app.route('/admin/usage', methods=['GET'])
+@require_admin_key
+def admin_usage():
+    """Aggregate the usage ledger, e.g. /admin/usage?group_by=key,model&since=2025-01-01."""
+    if USAGE_LEDGER is None:
+        return jsonify({'error': 'Usage ledger disabled (set USAGE_LEDGER_PATH)'}), 404
+
+    cfg = current_config()
+    group_by = [name.strip() for name in request.args.get('group_by', 'key,model').split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in USAGE_GROUP_COLUMNS]
+    if unknown:
+        return jsonify({'error': f"unknown group_by {unknown}, expected any of {sorted(USAGE_GROUP_COLUMNS)}"}), 400
+    try:
+        since = _parse_time_param(request.args.get('since'))
+        until = _parse_time_param(request.args.get('until'))
+    except ValueError as err:
+        return jsonify({'error': f"invalid since/until: {err}"}), 400
+
+    # 先把内存里的记录落盘，保证查询能看到刚结束的请求
+    USAGE_LEDGER.flush()
+    rows = USAGE_LEDGER.aggregate(group_by, since, until, request.args.get('key_id') or None)
+    if 'key' in group_by:
+        known = {_api_key_id(key): _mask_api_key(key) for key in cfg.allowed_api_keys}
+        for row in rows:
+            row['key_id'] = row.pop('key')
+            row['key'] = known.get(row['key_id'])
+    rows.sort(key=lambda row: (row['input_tokens'] + row['output_tokens']), reverse=True)
+    return jsonify({
+        'object': 'list',
+        'group_by': group_by,
+        'since': since,
+        'until': until,
+        'data': rows,
+        'ledger': {
+            'path': USAGE_LEDGER.path,
+            'format': USAGE_LEDGER.format,
+            'pending': USAGE_LEDGER.pending,
+            'dropped': USAGE_LEDGER.dropped,
+        }
     })
 
 @app.route('/health', methods=['GET'])
 def health():
-    safe_key_set = len(ALLOWED_API_KEYS)
+    cfg = current_config()
+    safe_key_set = len(cfg.allowed_api_keys)
     return jsonify({
         'status': 'ok',
-        'upstream_url': API_URL,
-        'default_model': DEFAULT_MODEL,
-        'model_aliases': MODEL_ALIASES,
+        'upstream_url': cfg.api_url,
+        'default_model': cfg.default_model,
+        'model_aliases': cfg.model_aliases,
         'allowed_api_keys_count': safe_key_set,
         'current_user_id': CURRENT_USER_ID,
         'last_update': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(LAST_UPDATE_TIME)) if LAST_UPDATE_TIME > 0 else 'Never',
         'next_update_in': f"{int((UPDATE_INTERVAL - (time.time() - LAST_UPDATE_TIME)) / 60)} minutes" if LAST_UPDATE_TIME > 0 else 'On first request'
     })
 
+
+print(f"⏱️ Proxy module ready in {(time.perf_counter() - _STARTUP_BEGAN) * 1000:.1f}ms")
+
 if __name__ == '__main__':
     PORT = int(os.getenv('PORT', 5000))
     print(f"🚀 Claude Proxy running on port {PORT}")
-    print(f"🔑 Allowed API keys: {len(ALLOWED_API_KEYS)}")
+    print(f"🔑 Allowed API keys: {len(CONFIG.allowed_api_keys)}")
     print(f"⏱️  User ID refresh interval: {UPDATE_INTERVAL / 3600} hours")
     app.config['JSON_AS_ASCII'] = False
+    install_reload_triggers()
 
     # 禁用 Flask 自带的请求日志，减少延迟
     import logging
@@ -0,0 +1,13 @@
+"""Gunicorn settings for claude_proxy; gunicorn loads ./gunicorn.conf.py automatically.
+
+Only hooks live here, command-line flags (workers, bind, timeout) stay in the
+Dockerfile / entrypoint.sh.
+"""
+
+
+def post_worker_init(worker):
+    # 配置热加载（文件监听线程 + SIGHUP）装在每个 worker 里：--preload 时模块在 master 中导入，
+    # master 自己处理 SIGHUP，线程也不会跨 fork 保留
+    import claude_proxy
+
+    claude_proxy.install_reload_triggers()
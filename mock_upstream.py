@@ -0,0 +1,391 @@
+"""Local stand-in for the upstream Anthropic Messages API.
+
+Used for benchmarks and troubleshooting without burning real upstream quota:
+
+    python mock_upstream.py --port 8900              # HTTP/1.1 (werkzeug)
+    python mock_upstream.py --port 8900 --http2      # HTTP/1.1 + h2c via hypercorn
+
+Point the proxy at it with UPSTREAM_API_URL=http://127.0.0.1:8900/v1/messages.
+Behaviour can be tuned per proxy instance through query parameters on that URL:
+`tokens` (number of text deltas, default 20), `delay` (seconds between deltas,
+default 0.01) and `first_delay` (seconds before the first delta, default 0).
+
+Fault injection for soak tests (`bench_proxy.py soak`), each a per-request probability:
+`error_rate` (529 overloaded), `malformed_rate` (an undecodable SSE `data:` line mid-stream),
+`drop_rate` (connection cut mid-stream) and `stall_rate` (the stream pauses for `stall`
+seconds, default 5). Requests for model `mock-clean` never get faults, and `mock-clean-N`
+also sends N deltas: the soak test uses them to check that healthy streams still finish.
+
+POST /v1/files stores uploads in memory and answers like the Files API (DELETE /v1/files/<id> removes them); `image`/`document`
+blocks that reference an unknown `file_id` get 404. `file_error_rate` (uploads fail with 500)
+and `file_expiry` (seconds before an uploaded file is forgotten, default 0 = never) exercise
+the proxy's fallback to inline images. STATS counts the bytes received per endpoint.
+
+Compressed request bodies (`Content-Encoding: gzip` / `zstd`) are rejected with
+415 like most vendors do, unless started with --accept-encoding.
+
+With --replay capture.jsonl (written by the proxy with CAPTURE_PATH) a request whose
+system prompt carries a `<<replay:N>>` marker gets line N's recorded upstream
+response back: same status, event sequence, payload sizes and timings.
+`bench_proxy.py replay` adds the markers and drives the proxy.
+"""
+import argparse
+import gzip
+import json
+import random
+import re
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+
+
+def _param(name: str, default: float) -> float:
+    try:
+        return float(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _read_body() -> Any:
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if not encoding:
+        return request.get_json(silent=True) or {}
+    if not app.config.get('ACCEPT_ENCODING'):
+        return None
+    raw = request.get_data()
+    if encoding == 'zstd':
+        import zstandard
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+    elif encoding == 'gzip':
+        raw = gzip.decompress(raw)
+    else:
+        return None
+    return json.loads(raw)
+
+
+# file_id -> 上传信息；STATS 记录各端点收到的请求数和字节数（bench_proxy.py images 读取）
+FILES: Dict[str, Dict[str, Any]] = {}
+STATS: Dict[str, int] = {'messages': 0, 'message_bytes': 0, 'files': 0, 'file_bytes': 0, 'deleted': 0}
+
+
+def _missing_file(content: Any) -> Optional[str]:
+    """First file_id referenced by the request that was never uploaded or has expired."""
+    if isinstance(content, list):
+        for item in content:
+            missing = _missing_file(item)
+            if missing:
+                return missing
+    elif isinstance(content, dict):
+        source = content.get('source')
+        if isinstance(source, dict) and source.get('type') == 'file':
+            stored = FILES.get(source.get('file_id'))
+            expiry = _param('file_expiry', 0)
+            if stored is None or (expiry > 0 and time.time() - stored['created'] > expiry):
+                return str(source.get('file_id'))
+        return _missing_file(content.get('content'))
+    return None
+
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    STATS['files'] += 1
+    STATS['file_bytes'] += request.content_length or 0
+    if random.random() < _param('file_error_rate', 0):
+        return jsonify({'type': 'error', 'error': {'type': 'api_error', 'message': 'mock upstream file store unavailable'}}), 500
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'type': 'error', 'error': {'type': 'invalid_request_error', 'message': 'file: Field required'}}), 400
+    size = len(upload.read())
+    file_id = f"file_{uuid.uuid4().hex[:24]}"
+    FILES[file_id] = {'created': time.time(), 'size': size}
+    return jsonify({
+        'id': file_id, 'type': 'file', 'filename': upload.filename, 'mime_type': upload.mimetype,
+        'size_bytes': size, 'created_at': datetime.now(timezone.utc).isoformat(), 'downloadable': False
+    })
+
+
+@app.route('/v1/files/<file_id>', methods=['DELETE'])
+def delete_file(file_id: str):
+    if FILES.pop(file_id, None) is None:
+        return jsonify({'type': 'error', 'error': {'type': 'not_found_error', 'message': f"File not found: {file_id}"}}), 404
+    STATS['deleted'] += 1
+    return jsonify({'id': file_id, 'type': 'file_deleted'})
+
+
+REPLAY_MARKER_RE = re.compile(rb'<<replay:(\d+)>>')
+FILLER = 'lorem ipsum dolor sit amet consectetur adipiscing elit '
+REPLAY_TRACES: Dict[int, Dict[str, Any]] = {}
+
+
+def load_replay(path: str) -> int:
+    """Index a capture file by line number; returns the number of traces."""
+    REPLAY_TRACES.clear()
+    with open(path, 'r', encoding='utf-8') as fh:
+        for number, line in enumerate(fh):
+            if line.strip():
+                REPLAY_TRACES[number] = json.loads(line).get('upstream') or {}
+    return len(REPLAY_TRACES)
+
+
+def _filler(size: int) -> str:
+    return (FILLER * (size // len(FILLER) + 1))[:size]
+
+
+def _replay_timeline(upstream: Dict[str, Any]) -> List[List[Any]]:
+    """Recorded [ms, event type, size] list; non-streamed captures are expanded into one burst."""
+    if upstream.get('events'):
+        return upstream['events']
+    at = upstream.get('headers_ms') or 0
+    timeline: List[List[Any]] = [[at, 'message_start', 0]]
+    for block_type, size in upstream.get('content') or [['text', 0]]:
+        timeline += [[at, f"content_block_start:{block_type}", 0], [at, 'content_block_delta', size],
+                     [at, 'content_block_stop', 0]]
+    return timeline + [[at, 'message_delta', 0], [at, 'message_stop', 0]]
+
+
+def _replay_events(upstream: Dict[str, Any], message_id: str, model: str, started: float) -> Iterator[Dict[str, Any]]:
+    usage = upstream.get('usage') or {}
+    blocks: List[Dict[str, Any]] = []
+    for at_ms, event_type, size in _replay_timeline(upstream):
+        wait = started + at_ms / 1000 - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        base, _, block_type = event_type.partition(':')
+        if base == 'message_start':
+            start_usage = {k: v for k, v in usage.items() if k != 'output_tokens'}
+            yield {'type': 'message_start', 'message': {
+                'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model,
+                'content': [], 'stop_reason': None, 'usage': dict(start_usage, output_tokens=1)
+            }}
+        elif base == 'content_block_start':
+            if block_type == 'tool_use':
+                block = {'type': 'tool_use', 'id': f"toolu_{uuid.uuid4().hex[:24]}", 'name': 'replayed_tool', 'input': {}}
+            elif block_type == 'thinking':
+                block = {'type': 'thinking', 'thinking': ''}
+            else:
+                block = {'type': 'text', 'text': ''}
+            blocks.append(dict(block, _deltas=0))
+            yield {'type': 'content_block_start', 'index': len(blocks) - 1, 'content_block': block}
+        elif base == 'content_block_delta' and blocks:
+            block = blocks[-1]
+            if block['type'] == 'tool_use':
+                # 工具参数拼起来必须是合法 JSON：首片带上 {"x":" 前缀，结束前补上 "}
+                delta = {'type': 'input_json_delta', 'partial_json': ('{"x":"' if not block['_deltas'] else '') + 'x' * size}
+            elif block['type'] == 'thinking':
+                delta = {'type': 'thinking_delta', 'thinking': _filler(size)}
+            else:
+                delta = {'type': 'text_delta', 'text': _filler(size)}
+            block['_deltas'] += 1
+            yield {'type': 'content_block_delta', 'index': len(blocks) - 1, 'delta': delta}
+        elif base == 'content_block_stop' and blocks:
+            block = blocks[-1]
+            if block['type'] == 'tool_use':
+                closing = '"}' if block['_deltas'] else '{}'
+                yield {'type': 'content_block_delta', 'index': len(blocks) - 1,
+                       'delta': {'type': 'input_json_delta', 'partial_json': closing}}
+            yield {'type': 'content_block_stop', 'index': len(blocks) - 1}
+        elif base == 'message_delta':
+            stop_reason = 'tool_use' if any(b['type'] == 'tool_use' for b in blocks) else 'end_turn'
+            yield {'type': 'message_delta', 'delta': {'stop_reason': stop_reason},
+                   'usage': {'output_tokens': usage.get('output_tokens', 0)}}
+        elif base in ('message_stop', 'ping'):
+            yield {'type': base}
+        elif base == 'error':
+            yield {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'replayed upstream error'}}
+
+
+def _replay(upstream: Dict[str, Any], body: Dict[str, Any], started: float):
+    model = body.get('model', 'mock-model')
+    message_id = f"msg_{uuid.uuid4().hex[:24]}"
+    status = upstream.get('status') or 200
+    if status != 200:
+        time.sleep(max(0.0, (upstream.get('headers_ms') or 0) / 1000 - (time.perf_counter() - started)))
+        return jsonify({'type': 'error', 'error': {'type': 'api_error', 'message': f"replayed upstream status {status}"}}), status
+    events = _replay_events(upstream, message_id, model, started)
+    if body.get('stream'):
+        return Response((_sse(event) for event in events), content_type='text/event-stream')
+
+    content: List[Dict[str, Any]] = []
+    message: Dict[str, Any] = {'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model,
+                               'content': content, 'stop_reason': 'end_turn', 'usage': upstream.get('usage') or {}}
+    for event in events:
+        if event['type'] == 'content_block_start':
+            content.append(dict(event['content_block']))
+        elif event['type'] == 'content_block_delta' and content:
+            delta = event['delta']
+            block = content[-1]
+            if 'partial_json' in delta:
+                block['_json'] = block.get('_json', '') + delta['partial_json']
+            else:
+                key = 'thinking' if 'thinking' in delta else 'text'
+                block[key] = block.get(key, '') + delta[key]
+        elif event['type'] == 'message_delta':
+            message['stop_reason'] = event['delta']['stop_reason']
+    for block in content:
+        if '_json' in block:
+            block['input'] = json.loads(block.pop('_json'))
+    return jsonify(message)
+
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode('utf-8')
+
+
+# 截断的 JSON 与非 UTF-8 字节，分别触发代理的 Stream decode error 两个分支
+MALFORMED_SSE = b'data: {"type": "content_block_delta", "index": 0, "delta": {"type": "text_del\n\ndata: \xff\xfe\n\n'
+
+
+# 不注入故障的模型名，mock-clean-N 同时指定 delta 数
+CLEAN_MODEL_RE = re.compile(r'^mock-clean(?:-(\d+))?$')
+
+
+def _fault_plan(tokens: int) -> Dict[str, Any]:
+    """Decide up front which faults this stream gets and at which delta."""
+    plan: Dict[str, Any] = {}
+    if random.random() < _param('malformed_rate', 0):
+        plan['malformed'] = random.randrange(max(tokens, 1))
+    if random.random() < _param('drop_rate', 0):
+        plan['drop'] = random.randrange(max(tokens, 1))
+    elif random.random() < _param('stall_rate', 0):
+        plan['stall'] = random.randrange(max(tokens, 1))
+        plan['stall_seconds'] = _param('stall', 5)
+    if plan:
+        # werkzeug 下可以直接关闭 socket；hypercorn 没有暴露 socket，改为抛异常中断流
+        plan['socket'] = request.environ.get('werkzeug.socket')
+    return plan
+
+
+def _drop_connection(plan: Dict[str, Any]) -> None:
+    sock = plan.get('socket')
+    if sock is None:
+        raise ConnectionAbortedError('mock upstream dropped the stream')
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _stream_events(message_id: str, model: str, tokens: int, delay: float, first_delay: float,
+                   faults: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    faults = faults or {}
+    yield _sse({
+        'type': 'message_start',
+        'message': {
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model,
+            'content': [], 'stop_reason': None, 'usage': {'input_tokens': 10, 'output_tokens': 1}
+        }
+    })
+    yield _sse({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+    if first_delay > 0:
+        time.sleep(first_delay)
+    for i in range(tokens):
+        if faults.get('malformed') == i:
+            yield MALFORMED_SSE
+        if faults.get('drop') == i:
+            _drop_connection(faults)
+            return
+        if faults.get('stall') == i:
+            time.sleep(faults['stall_seconds'])
+        yield _sse({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': f"tok{i} "}})
+        if delay > 0:
+            time.sleep(delay)
+    yield _sse({'type': 'content_block_stop', 'index': 0})
+    yield _sse({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': tokens}})
+    yield _sse({'type': 'message_stop'})
+
+
+@app.route('/v1/messages', methods=['POST'])
+def messages():
+    started = time.perf_counter()
+    STATS['messages'] += 1
+    STATS['message_bytes'] += request.content_length or 0
+    marker = REPLAY_MARKER_RE.search(request.get_data()) if REPLAY_TRACES else None
+    body = _read_body()
+    if marker is None and REPLAY_TRACES and body is not None:
+        # 压缩请求体时标记只在解压后可见
+        marker = REPLAY_MARKER_RE.search(json.dumps(body.get('system', '')).encode('utf-8'))
+    if body is None:
+        return jsonify({'type': 'error', 'error': {
+            'type': 'invalid_request_error',
+            'message': f"Unsupported Content-Encoding: {request.headers.get('Content-Encoding')}"
+        }}), 415
+    if marker is not None and int(marker.group(1)) in REPLAY_TRACES:
+        return _replay(REPLAY_TRACES[int(marker.group(1))], body, started)
+    missing = _missing_file(body.get('messages'))
+    if missing:
+        return jsonify({'type': 'error', 'error': {'type': 'not_found_error', 'message': f"File not found: {missing}"}}), 404
+    model = body.get('model', 'mock-model')
+    clean = CLEAN_MODEL_RE.match(str(model))
+    if not clean and random.random() < _param('error_rate', 0):
+        return jsonify({'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'mock upstream overloaded'}}), 529
+    tokens = int(clean.group(1)) if clean and clean.group(1) else int(_param('tokens', 20))
+    delay = _param('delay', 0.01)
+    first_delay = _param('first_delay', 0)
+    message_id = f"msg_{uuid.uuid4().hex[:24]}"
+
+    if body.get('stream'):
+        return Response(
+            _stream_events(message_id, model, tokens, delay, first_delay, None if clean else _fault_plan(tokens)),
+            content_type='text/event-stream'
+        )
+
+    time.sleep(first_delay + delay * tokens)
+    return jsonify({
+        'id': message_id,
+        'type': 'message',
+        'role': 'assistant',
+        'model': model,
+        'content': [{'type': 'text', 'text': ''.join(f"tok{i} " for i in range(tokens))}],
+        'stop_reason': 'end_turn',
+        'usage': {'input_tokens': 10, 'output_tokens': tokens}
+    })
+
+
+def _serve_http2(port: int, threads: int) -> None:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.accesslog = None
+
+    async def _main() -> None:
+        # hypercorn 在默认线程池里运行 WSGI 应用；放大线程池以支撑大量并发慢速流
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads))
+        await serve(app, config)
+
+    asyncio.run(_main())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--http2', action='store_true', help='serve HTTP/1.1 and h2c with hypercorn')
+    parser.add_argument('--threads', type=int, default=512, help='WSGI threads when using --http2')
+    parser.add_argument('--accept-encoding', action='store_true', help='accept gzip/zstd request bodies')
+    parser.add_argument('--replay', metavar='CAPTURE_JSONL', help='answer <<replay:N>> requests from a capture file')
+    args = parser.parse_args()
+    app.config['ACCEPT_ENCODING'] = args.accept_encoding
+    if args.replay:
+        print(f"🎞️ Loaded {load_replay(args.replay)} traces from {args.replay}")
+
+    print(f"🧪 Mock upstream on http://127.0.0.1:{args.port}/v1/messages ({'h2c + http/1.1' if args.http2 else 'http/1.1'})")
+    if args.http2:
+        _serve_http2(args.port, args.threads)
+    else:
+        import logging
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        app.run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()